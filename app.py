@@ -1,22 +1,94 @@
 import os
+import gzip
 import json
+import hmac
+import math
+import hashlib
+from functools import wraps
+from itertools import chain as iter_chain
 import langchain_core.exceptions
 import lark.exceptions
 import pymongo.errors
-from flask import Flask, jsonify, request
+import requests
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context
 from dotenv import load_dotenv
+
+# Loaded before the `rag` modules are imported, they read their configuration at import
+load_dotenv()
+
 from langchain_core.documents import Document
+from rag import deadline
+from rag.candidate_cache import CandidateCache, decode_cursor, encode_cursor
+from rag.projection_vector_store import MAX_NUM_CANDIDATES
+from rag.request_profiler import RequestProfiler, active_callbacks, stats_to_text
 from rag.rag_setup import (
     vector_search_chain,
     rag_chain,
     self_querying_vector_search_chain,
-    self_querying_rag_chain
+    self_querying_rag_chain,
+    warm_up_query,
+    EMBEDDING_ROUTER
 )
+from rag.warmup import WarmUp, top_queries
 
-load_dotenv()
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
+# Default deadline of a request in seconds, overridable with `X-Request-Timeout` header or `timeout` parameter
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
+
+# Default number of documents fetched from MongoDB per cursor batch when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "16"))
+
+SEARCH_TYPES = ("similarity", "similarity_score_threshold", "mmr")
+
+# Number of pages of ranked candidates fetched and cached by the first paginated request
+PAGINATION_PAGES = int(os.getenv("PAGINATION_PAGES", "10"))
+
+# All pages fetched by the first paginated request have to fit into a single vector search
+MAX_PAGE_SIZE = MAX_NUM_CANDIDATES // PAGINATION_PAGES
+
+CANDIDATE_CACHE = CandidateCache(
+    ttl=float(os.getenv("CANDIDATE_CACHE_TTL", "300")),
+    max_entries=int(os.getenv("CANDIDATE_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("CANDIDATE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+
+PROFILER = RequestProfiler(
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    history=int(os.getenv("PROFILE_HISTORY", "50")),
+)
+
+# Readiness waits until this fraction of the warm-up queries is done, 0 does not wait
+WARMUP_READY_FRACTION = float(os.getenv("WARMUP_READY_FRACTION", "0"))
+
+def start_warm_up():
+    """Warm up the query caches in the background with the most frequent queries of `WARMUP_QUERY_LOG`."""
+    query_log = os.getenv("WARMUP_QUERY_LOG")
+    if not query_log:
+        return None
+    try:
+        queries = top_queries(query_log, int(os.getenv("WARMUP_TOP_N", "100")))
+    except (OSError, ValueError) as e:
+        print("An error occurred:", e)
+        return None
+    rate = float(os.getenv("WARMUP_RATE", "2"))
+    return WarmUp(queries, warm_up_query, rate=rate or None).start()
+
+WARMUP = start_warm_up()
+
+# Responses smaller than this number of bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "text/html", "text/plain"}
+
+# Content encodings in order of preference, brotli only when the optional package is installed
+CONTENT_ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
 @app.route("/")
 def hello_world():
     return "<p>Hello, World! </p>"
@@ -25,57 +97,327 @@ def get_custom_projection(custom_projection):
     if not custom_projection:
         return {'$project': {
             '_id': 0,
-            os.getenv("EMBEDDING_KEY"): 0}}
+            **{embedding_key: 0 for embedding_key in EMBEDDING_ROUTER.embedding_keys()}}}
     return json.loads(custom_projection)
 
-def process_request(chain_func, query, custom_projection, docs_num):
-    custom_projection = get_custom_projection(custom_projection)
-    chain = chain_func(custom_projection, docs_num)
-    try:
-        result = chain.invoke(query)
-    except langchain_core.exceptions.OutputParserException as e:
-        print("An error occurred:", e)
+def is_admin():
+    admin_token = os.getenv("ADMIN_TOKEN")
+    return bool(admin_token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token)
+
+def profiled(func):
+    """Profile the request when requested by an admin with `profile=1` or sampled."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        requested = request.args.get('profile') == '1' and is_admin()
+        if not PROFILER.should_profile(requested):
+            return func(*args, **kwargs)
+        return PROFILER.profile(func, request.path, request.args.to_dict(), *args, **kwargs)
+    return wrapper
+
+def handle_error(e):
+    print("An error occurred:", e)
+    if isinstance(e, (deadline.DeadlineExceeded, pymongo.errors.ExecutionTimeout, requests.Timeout)):
+        return "The request deadline was exceeded", 504
+    if isinstance(e, langchain_core.exceptions.OutputParserException):
         return "There was a problem with parsing filters", 400
-    except lark.exceptions.UnexpectedToken as e:
-        print("An error occurred:", e)
+    if isinstance(e, lark.exceptions.UnexpectedToken):
         return "There was a problem with parsing filters", 400
-    except pymongo.errors.OperationFailure as e:
-        print("An error occurred:", e)
+    if isinstance(e, pymongo.errors.OperationFailure):
         return "There was a problem with filters in MongoDB", 500
+    return "There was an unknown problem", 500
+
+@profiled
+def process_request(chain_func, query, custom_projection, docs_num, search_options=None):
+    custom_projection = get_custom_projection(custom_projection)
+    chain = chain_func(custom_projection, docs_num, **(search_options or {}))
+    timeout = get_request_timeout()
+    try:
+        with deadline.deadline_scope(timeout):
+            result = chain.invoke(query, config={"callbacks": active_callbacks()})
     except Exception as e:
-        print("An error occurred:", e)
-        return "There was an unknown problem", 500
+        return handle_error(e)
     if isinstance(result, list):
-        result = docs_to_json(result)
+        return conditional_response(result)
+    if isinstance(result, dict):
+        return answer_response(result)
     return jsonify(result), 200
 
+def answer_response(result):
+    """Return the answer of RAG chain, or the retrieved documents with partial or absent answer
+    when generation was degraded to meet the request deadline."""
+    headers = {"X-Degradation-Mode": result["degradation"]}
+    if result["degradation"] == deadline.DEGRADATION_NONE:
+        return jsonify(result["answer"]), 200, headers
+    return jsonify({
+        "answer": result["answer"],
+        "documents": docs_to_json(result["context"]),
+        "degradation": result["degradation"],
+    }), 200, headers
+
+def documents_etag(docs):
+    """Return strong ETag of the request parameters and the ids and contents of the returned documents."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(sorted(request.args.items(multi=True))).encode())
+    for doc in docs:
+        digest.update(str(doc.metadata.get('_id')).encode())
+        digest.update(doc.page_content.encode())
+        digest.update(json.dumps(doc.metadata, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:32]
+
+def conditional_response(docs):
+    """Return documents, or 304 without serializing them when the client has them cached already.
+
+    The ETag of a compressed response has the content encoding appended, e.g. `"<hash>-gzip"`,
+    so `If-None-Match` matches the ETag of the documents regardless of the encoding.
+    """
+    etag = documents_etag(docs)
+    matched = [tag for tag in request.if_none_match.as_set(include_weak=True) if tag.split('-', 1)[0] == etag]
+    if matched or request.if_none_match.star_tag:
+        return Response(status=304, headers={
+            "ETag": f'"{matched[0] if matched else etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding"})
+    response = jsonify(docs_to_json(docs))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
+
+def process_stream_request(chain_func, query, custom_projection, docs_num, batch_size, search_options=None):
+    """Stream documents as NDJSON, one document per line.
+
+    The first document is fetched before the response is started, so errors
+    from the query constructor, embedding or MongoDB still map to a proper status code.
+    """
+    custom_projection = get_custom_projection(custom_projection)
+    chain = chain_func(custom_projection, docs_num, **(search_options or {}))
+    docs = chain.stream_relevant_documents(query, batch_size=batch_size)
+    timeout = get_request_timeout()
+    try:
+        with deadline.deadline_scope(timeout):
+            first = next(docs, None)
+    except Exception as e:
+        return handle_error(e)
+    if first is None:
+        return Response("", mimetype="application/x-ndjson"), 200
+
+    def generate():
+        for doc in iter_chain([first], docs):
+            yield app.json.dumps(doc_to_json(doc)) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson"), 200
+
+def paginated_response(docs, entry_id, offset, page_size):
+    """Return page of documents with a cursor to the next page.
+
+    `truncated` is true when more documents were found but could not be cached,
+    so the following pages cannot be requested.
+    """
+    next_offset = offset + page_size
+    next_cursor = None
+    if entry_id is not None and next_offset < len(docs):
+        next_cursor = encode_cursor(entry_id, next_offset, page_size)
+    return jsonify({
+        "documents": docs[offset:next_offset],
+        "next_cursor": next_cursor,
+        "truncated": entry_id is None and next_offset < len(docs),
+    }), 200
+
+def process_paginated_request(chain_func, query, custom_projection, page_size, search_options=None):
+    """Return the first page of documents and a cursor to the following pages.
+
+    `PAGINATION_PAGES` pages of ranked candidates are fetched at once and cached,
+    so following pages are served without embedding the query or querying MongoDB.
+    """
+    custom_projection = get_custom_projection(custom_projection)
+    chain = chain_func(custom_projection, page_size * PAGINATION_PAGES, **(search_options or {}))
+    timeout = get_request_timeout()
+    try:
+        with deadline.deadline_scope(timeout):
+            docs = docs_to_json(chain.invoke(query))
+    except Exception as e:
+        return handle_error(e)
+    entry_id = CANDIDATE_CACHE.put(docs) if len(docs) > page_size else None
+    return paginated_response(docs, entry_id, 0, page_size)
+
+def process_cursor_request(cursor, page_size=None):
+    """Return the page of cached documents the cursor points at.
+
+    The page size defaults to the page size of the request which started the pagination.
+    """
+    try:
+        entry_id, offset, cursor_page_size = decode_cursor(cursor)
+    except ValueError:
+        return "The cursor is malformed", 400
+    docs = CANDIDATE_CACHE.get(entry_id)
+    if docs is None:
+        return "The cursor has expired", 410
+    return paginated_response(docs, entry_id, offset, page_size or cursor_page_size)
+
+def get_page_size():
+    if not request.args.get('page_size'):
+        return None
+    try:
+        page_size = int(request.args.get('page_size'))
+    except ValueError:
+        page_size = 0
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        abort(400, description=f"page_size must be an integer between 1 and {MAX_PAGE_SIZE}")
+    return page_size
+
+def get_search_options():
+    """Return search type and its keyword arguments from request parameters.
+
+    `fetch_k` and `lambda_mult` only apply to `mmr` and are ignored for other search types.
+    """
+    search_type = request.args.get('search_type', 'similarity')
+    if search_type not in SEARCH_TYPES:
+        abort(400, description=f"Unknown search_type {search_type}, expected one of {list(SEARCH_TYPES)}")
+    search_kwargs = {}
+    try:
+        if request.args.get('score_threshold'):
+            search_kwargs['score_threshold'] = float(request.args.get('score_threshold'))
+        if search_type == 'mmr' and request.args.get('fetch_k'):
+            search_kwargs['fetch_k'] = int(request.args.get('fetch_k'))
+        if search_type == 'mmr' and request.args.get('lambda_mult'):
+            search_kwargs['lambda_mult'] = float(request.args.get('lambda_mult'))
+    except ValueError:
+        abort(400, description="score_threshold, fetch_k and lambda_mult must be numbers")
+    try:
+        version = EMBEDDING_ROUTER.route(request.args.get('query'), request.args.get('embedding_version'))
+    except ValueError as e:
+        abort(400, description=str(e))
+    g.embedding_version = version.name
+    return {
+        'search_type': search_type,
+        'search_kwargs': search_kwargs,
+        'embedding_version': version.name,
+    }
+
+def get_request_timeout():
+    timeout = request.headers.get('X-Request-Timeout') or request.args.get('timeout')
+    if not timeout:
+        return REQUEST_TIMEOUT
+    try:
+        seconds = float(timeout)
+    except ValueError:
+        seconds = math.nan
+    if not 0 < seconds < math.inf:
+        abort(400, description="The request timeout must be a positive number of seconds")
+    return seconds
+
+def is_stream_requested():
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+def get_batch_size():
+    if not request.args.get('batch_size'):
+        return STREAM_BATCH_SIZE
+    try:
+        batch_size = int(request.args.get('batch_size'))
+    except ValueError:
+        batch_size = 0
+    if batch_size <= 0:
+        abort(400, description="batch_size must be a positive integer")
+    return batch_size
+
+@app.after_request
+def add_embedding_version(response):
+    """Report the embedding version the request was routed to."""
+    if 'embedding_version' in g:
+        response.headers["X-Embedding-Version"] = g.embedding_version
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress the response with the best content encoding accepted by the client."""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS)
+    if encoding is None:
+        return response
+    if encoding == "br":
+        response.set_data(brotli.compress(data, quality=min(COMPRESSION_LEVEL, 11)))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESSION_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
 @app.route("/vector-search")
 def vector_search():
     query = request.args.get('query')
     custom_projection = request.args.get('projection')
     docs_num = int(request.args.get('docs_num')) if request.args.get('docs_num') else 3
-    return process_request(vector_search_chain, query, custom_projection, docs_num)
+    if request.args.get('cursor'):
+        return process_cursor_request(request.args.get('cursor'), get_page_size())
+    page_size = get_page_size()
+    if page_size:
+        return process_paginated_request(
+            vector_search_chain, query, custom_projection, page_size, get_search_options())
+    if is_stream_requested():
+        return process_stream_request(
+            vector_search_chain, query, custom_projection, docs_num, get_batch_size(), get_search_options())
+    return process_request(vector_search_chain, query, custom_projection, docs_num, get_search_options())
 
 @app.route("/rag")
 def rag():
     query = request.args.get('query')
     custom_projection = request.args.get('projection')
     docs_num = int(request.args.get('docs_num')) if request.args.get('docs_num') else 3
-    return process_request(rag_chain, query, custom_projection, docs_num)
+    return process_request(rag_chain, query, custom_projection, docs_num, get_search_options())
 
 @app.route("/sq-vector-search")
 def self_querying_vector_search():
     query = request.args.get('query')
     custom_projection = request.args.get('projection')
     docs_num = int(request.args.get('docs_num')) if request.args.get('docs_num') else 3
-    return process_request(self_querying_vector_search_chain, query, custom_projection, docs_num)
+    if request.args.get('cursor'):
+        return process_cursor_request(request.args.get('cursor'), get_page_size())
+    page_size = get_page_size()
+    if page_size:
+        return process_paginated_request(
+            self_querying_vector_search_chain, query, custom_projection, page_size, get_search_options())
+    if is_stream_requested():
+        return process_stream_request(self_querying_vector_search_chain, query, custom_projection, docs_num,
+                                      get_batch_size(), get_search_options())
+    return process_request(self_querying_vector_search_chain, query, custom_projection, docs_num, get_search_options())
 
 @app.route("/sq-rag")
 def self_querying_rag():
     query = request.args.get('query')
     custom_projection = request.args.get('projection')
     docs_num = int(request.args.get('docs_num')) if request.args.get('docs_num') else 3
-    return process_request(self_querying_rag_chain, query, custom_projection, docs_num)
+    return process_request(self_querying_rag_chain, query, custom_projection, docs_num, get_search_options())
+
+@app.route("/ready")
+def ready():
+    """Report readiness, waiting for `WARMUP_READY_FRACTION` of the warm-up when configured."""
+    if WARMUP is None:
+        return jsonify({"ready": True}), 200
+    is_ready = WARMUP.finished.is_set() or WARMUP.fraction >= WARMUP_READY_FRACTION
+    return jsonify({"ready": is_ready, "warmup": WARMUP.progress()}), 200 if is_ready else 503
+
+@app.route("/admin/profiles")
+def list_profiles():
+    if not is_admin():
+        abort(403)
+    return jsonify(PROFILER.recent()), 200
+
+@app.route("/admin/profiles/<profile_id>")
+def download_profile(profile_id):
+    if not is_admin():
+        abort(403)
+    profile = PROFILER.get(profile_id)
+    if profile is None:
+        abort(404)
+    if request.args.get('format') == 'text':
+        return Response(stats_to_text(profile["stats"]), mimetype="text/plain"), 200
+    return Response(profile["stats"], mimetype="application/octet-stream", headers={
+        "Content-Disposition": f"attachment; filename={profile_id}.prof"}), 200
 
 def docs_to_json(docs: list[Document]) -> list:
     """Convert Documents to JSON format.
@@ -85,11 +427,18 @@ def docs_to_json(docs: list[Document]) -> list:
     Returns:
         List of Documents converted to JSON format.
     """
-    json_docs = []
-    for doc in docs:
-        doc.metadata.pop('_id', None)
-        json_docs.append(doc.to_json())
-    return json_docs
+    return [doc_to_json(doc) for doc in docs]
+
+def doc_to_json(doc: Document) -> dict:
+    """Convert a single Document to JSON format.
+
+    Removes '_id' field for proper JSON conversion.
+
+    Returns:
+        Document converted to JSON format.
+    """
+    doc.metadata.pop('_id', None)
+    return doc.to_json()
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,154 @@
+"""Throttled backfill of a candidate embedding version next to the current embeddings.
+
+Documents keep their current embedding in `EMBEDDING_KEY` and get the embedding of the
+candidate model `CANDIDATE_EMBEDDING_MODEL_NAME` in `CANDIDATE_EMBEDDING_KEY`, so the API keeps
+serving from the current version during the backfill. Documents are processed in `_id` order
+and only documents without the candidate embedding are written, so an interrupted backfill
+continues where it stopped.
+
+Run from the project root, with the versions configured in the .env file:
+    python -m misc.backfill_embeddings create-index
+    python -m misc.backfill_embeddings run --rate 50
+    python -m misc.backfill_embeddings status
+"""
+import argparse
+import os
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+from pymongo.operations import SearchIndexModel
+from sentence_transformers import SentenceTransformer
+
+from misc.encoder import document_text
+from rag.embedding_versions import DEFAULT_EMBEDDING_MODEL_NAME
+
+load_dotenv()
+
+# Documents the embeddings are computed for, see `misc/encoder.py`
+EMBEDDABLE = {"title": {"$exists": True}}
+
+
+def backfill_progress(collection: Collection, embedding_key: str) -> Dict:
+    """Return number of documents with the embedding in `embedding_key` out of all embeddable documents."""
+    total = collection.count_documents(EMBEDDABLE)
+    done = collection.count_documents({**EMBEDDABLE, embedding_key: {"$exists": True}})
+    return {"done": done, "total": total, "fraction": done / total if total else 1.0}
+
+
+def backfill(collection: Collection, model: SentenceTransformer, embedding_key: str, batch_size: int = 64,
+             rate: Optional[float] = None) -> int:
+    """Write embeddings of the model to `embedding_key` of documents which do not have them yet.
+
+    Args:
+        collection: Collection of the documents.
+        model: Model computing the embeddings.
+        embedding_key: Field the embeddings are written to.
+        batch_size: (Optional) number of documents embedded and written at once. Defaults to 64.
+        rate: (Optional) maximal number of documents written per second. Defaults to None,
+            which does not limit the rate.
+
+    Returns:
+        Number of written embeddings.
+    """
+    progress = backfill_progress(collection, embedding_key)
+    remaining = progress["total"] - progress["done"]
+    print(f"Backfilling {remaining} of {progress['total']} documents into '{embedding_key}'")
+
+    query = {**EMBEDDABLE, embedding_key: {"$exists": False}}
+    projection = {"title": 1, "fullplot": 1}
+    written = 0
+    last_id = None
+    start = time.monotonic()
+    while True:
+        batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+        docs = list(collection.find(batch_query, projection).sort("_id", 1).limit(batch_size))
+        if not docs:
+            break
+        vectors = model.encode([document_text(doc) for doc in docs], batch_size=batch_size)
+        # The filter keeps embeddings written concurrently, e.g. by a second backfill
+        collection.bulk_write([
+            UpdateOne({"_id": doc["_id"], embedding_key: {"$exists": False}},
+                      {"$set": {embedding_key: vector.tolist()}})
+            for doc, vector in zip(docs, vectors)
+        ], ordered=False)
+        written += len(docs)
+        last_id = docs[-1]["_id"]
+
+        elapsed = time.monotonic() - start
+        if rate:
+            time.sleep(max(0.0, written / rate - elapsed))
+            elapsed = time.monotonic() - start
+        speed = written / elapsed if elapsed else 0.0
+        eta = (remaining - written) / speed if speed else 0.0
+        print(f"Backfilled {written}/{remaining} documents, {speed:.1f} docs/s, ETA {eta:.0f}s")
+    print(f"Backfilled {written} documents into '{embedding_key}'")
+    return written
+
+
+def create_index(collection: Collection, model: SentenceTransformer, embedding_key: str, index_name: str,
+                 current_index_name: Optional[str] = None) -> None:
+    """Create vector search index over `embedding_key`.
+
+    The definition is copied from the current index when it exists, so the filter fields
+    used by self-querying stay indexed, and only the path and dimensions of the vector change.
+    """
+    dimensions = model.get_sentence_embedding_dimension()
+    fields = []
+    if current_index_name:
+        for index in collection.list_search_indexes(current_index_name):
+            fields = [field for field in index.get("latestDefinition", {}).get("fields", [])
+                      if field.get("type") != "vector"]
+    fields.append({"type": "vector", "path": embedding_key, "numDimensions": dimensions, "similarity": "cosine"})
+    collection.create_search_index(SearchIndexModel({"fields": fields}, name=index_name, type="vectorSearch"))
+    print(f"Created vector search index '{index_name}' over '{embedding_key}' with {dimensions} dimensions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model",
+                        default=os.getenv("CANDIDATE_EMBEDDING_MODEL_NAME") or DEFAULT_EMBEDDING_MODEL_NAME,
+                        help="Embedding model. Defaults to CANDIDATE_EMBEDDING_MODEL_NAME.")
+    parser.add_argument("--embedding-key", default=os.getenv("CANDIDATE_EMBEDDING_KEY"),
+                        help="Field the embeddings are written to. Defaults to CANDIDATE_EMBEDDING_KEY.")
+    parser.add_argument("--index-name", default=os.getenv("CANDIDATE_INDEX_NAME"),
+                        help="Vector search index over the field. Defaults to CANDIDATE_INDEX_NAME.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Backfill the embeddings.")
+    run.add_argument("--batch-size", type=int, default=64, help="Documents embedded and written at once.")
+    run.add_argument("--rate", type=float, help="Maximal number of documents written per second.")
+    commands.add_parser("status", help="Print the progress of the backfill.")
+    commands.add_parser("create-index", help="Create the vector search index over the field.")
+    args = parser.parse_args()
+    if not args.embedding_key:
+        parser.error("--embedding-key or CANDIDATE_EMBEDDING_KEY is required")
+    if args.embedding_key == os.getenv("EMBEDDING_KEY"):
+        parser.error("The backfill must not overwrite the current EMBEDDING_KEY")
+    if args.command == "create-index" and not args.index_name:
+        parser.error("--index-name or CANDIDATE_INDEX_NAME is required")
+
+    client = MongoClient(os.getenv("MONGO_URI"))
+    try:
+        collection = client[os.getenv("DB_NAME")][os.getenv("COLL_NAME")]
+        if args.command == "status":
+            progress = backfill_progress(collection, args.embedding_key)
+            print(f"Backfilled {progress['done']}/{progress['total']} documents ({progress['fraction']:.1%})")
+            return
+
+        model = SentenceTransformer(args.model)
+        if args.command == "run":
+            backfill(collection, model, args.embedding_key, batch_size=args.batch_size, rate=args.rate)
+        else:
+            try:
+                create_index(collection, model, args.embedding_key, args.index_name, os.getenv("INDEX_NAME"))
+            except OperationFailure as e:
+                print("An error occurred:", e)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
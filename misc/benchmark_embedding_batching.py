@@ -0,0 +1,87 @@
+"""Benchmark of query embedding throughput and latency with and without micro-batching.
+
+Every concurrency level runs closed-loop threads embedding queries for a fixed time.
+By default the model of the API is used, `--fake` uses a stand-in with a fixed cost
+per forward pass instead.
+
+Run from the project root:
+    python -m misc.benchmark_embedding_batching
+    python -m misc.benchmark_embedding_batching --fake --batch-size 16 --wait-ms 1
+"""
+import argparse
+import threading
+import time
+
+from misc.load_test import percentile
+from rag.embedding_batcher import BatchingEmbeddings
+
+QUERIES = [
+    "space adventure with robots",
+    "romantic comedy in Paris",
+    "detective solving a murder in London",
+    "animated movie about talking animals",
+    "war drama set in the trenches of World War I",
+    "heist movie with a twist ending",
+]
+
+
+def measure(embedding, concurrency, duration):
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker(offset):
+        local = []
+        i = offset
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            embedding.embed_query(QUERIES[i % len(QUERIES)])
+            local.append(time.perf_counter() - start)
+            i += 1
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), time.perf_counter() - start
+
+
+def report(concurrency, name, latencies, elapsed, batcher=None):
+    line = (f"{concurrency:>11}  {name:<8}{len(latencies) / elapsed:>9.1f}"
+            f"{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}")
+    if batcher is not None and batcher.average_batch_size is not None:
+        line += f"{batcher.average_batch_size:>12.1f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fake", action="store_true", help="Use a fake model instead of the model of the API.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Maximal batch size.")
+    parser.add_argument("--wait-ms", type=float, default=2.0, help="Maximal wait for a batch in milliseconds.")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="Comma separated concurrency levels.")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds every measurement runs for.")
+    args = parser.parse_args()
+
+    if args.fake:
+        from misc.fakes import FakeEncoderEmbeddings
+        model = FakeEncoderEmbeddings(size=384)
+    else:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    model.embed_query("warm-up")
+
+    print(f"max batch size {args.batch_size}, max wait {args.wait_ms} ms")
+    print(f"{'concurrency':>11}  {'mode':<8}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'avg batch':>12}")
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        report(concurrency, "direct", *measure(model, concurrency, args.duration))
+        batcher = BatchingEmbeddings(model, max_batch_size=args.batch_size, max_wait=args.wait_ms / 1000)
+        report(concurrency, "batched", *measure(batcher, concurrency, args.duration), batcher)
+
+
+if __name__ == "__main__":
+    main()
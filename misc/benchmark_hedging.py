@@ -0,0 +1,68 @@
+"""Benchmark of hedged MongoDB aggregations and LLM calls against fake backends with latency spikes.
+
+Run from the project root:
+    python -m misc.benchmark_hedging
+"""
+import random
+import time
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from misc.fakes import FakeCollection, FakeOllamaServer
+from misc.load_test import percentile
+from rag.hedging import Hedger
+from rag.llm_pool import OllamaBackendPool, PooledOllama
+from rag.projection_vector_store import MongoDBAtlasProjectionVectorStore
+
+
+def measure(call, requests):
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def report(name, latencies, hedger=None):
+    line = (f"  {name:<10} p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  "
+            f"p95 {percentile(latencies, 0.95) * 1000:7.1f} ms  p99 {percentile(latencies, 0.99) * 1000:7.1f} ms")
+    if hedger is not None:
+        line += f"  hedged {hedger.hedged}/{hedger.calls}, hedge won {hedger.hedge_wins}"
+    print(line)
+
+
+def benchmark_mongo(requests=300):
+    print("MongoDB aggregation, 20 ms latency, 5% spikes of 300 ms")
+    collection = FakeCollection(latency=0.02, spike_latency=0.3, spike_rate=0.05, embedding_size=8)
+    embedding = DeterministicFakeEmbedding(size=8)
+
+    plain = MongoDBAtlasProjectionVectorStore(collection, embedding, index_name="index")
+    report("plain", measure(lambda: plain.similarity_search_with_score("query"), requests))
+
+    hedger = Hedger(percentile=90, budget=0.1)
+    hedged = MongoDBAtlasProjectionVectorStore(collection, embedding, index_name="index", hedger=hedger,
+                                               hedge_collection=collection.with_options())
+    report("hedged", measure(lambda: hedged.similarity_search_with_score("query"), requests), hedger)
+
+
+def benchmark_llm(requests=200):
+    print("LLM calls over 2 backends, 20 ms latency, 5% spikes of 300 ms")
+    servers = [FakeOllamaServer(latency=0.02, spike_latency=0.3, spike_rate=0.05).start() for _ in range(2)]
+    try:
+        plain = PooledOllama(pool=OllamaBackendPool([server.url for server in servers]), model="fake")
+        report("plain", measure(lambda: plain.invoke("prompt"), requests))
+
+        hedger = Hedger(percentile=90, budget=0.1)
+        pool = OllamaBackendPool([server.url for server in servers], hedger=hedger)
+        hedged = PooledOllama(pool=pool, model="fake")
+        report("hedged", measure(lambda: hedged.invoke("prompt"), requests), hedger)
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    benchmark_mongo()
+    benchmark_llm()
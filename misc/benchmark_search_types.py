@@ -0,0 +1,88 @@
+"""Benchmarks of MMR and score threshold search types against naive per-candidate loops.
+
+Run from the project root:
+    python -m misc.benchmark_search_types
+"""
+import math
+import random
+import timeit
+
+import bson
+import numpy as np
+
+from rag.mmr import maximal_marginal_relevance
+
+EMBEDDING_SIZE = 384
+
+
+def naive_maximal_marginal_relevance(query_embedding, embeddings, k=4, lambda_mult=0.5):
+    def cosine(a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm else 0.0
+
+    selected = []
+    while len(selected) < min(k, len(embeddings)):
+        best_index, best_score = None, -math.inf
+        for i, candidate in enumerate(embeddings):
+            if i in selected:
+                continue
+            redundancy = max((cosine(candidate, embeddings[j]) for j in selected), default=0.0)
+            score = lambda_mult * cosine(candidate, query_embedding) - (1 - lambda_mult) * redundancy
+            if score > best_score:
+                best_index, best_score = i, score
+        selected.append(best_index)
+    return selected
+
+
+def benchmark_mmr(k=10, repeat=3):
+    print(f"MMR, k={k}, embedding size={EMBEDDING_SIZE}")
+    for fetch_k in (20, 100, 500):
+        query = [random.gauss(0, 1) for _ in range(EMBEDDING_SIZE)]
+        embeddings = [[random.gauss(0, 1) for _ in range(EMBEDDING_SIZE)] for _ in range(fetch_k)]
+        assert naive_maximal_marginal_relevance(query, embeddings, k) == \
+            maximal_marginal_relevance(query, embeddings, k)
+        naive = min(timeit.repeat(
+            lambda: naive_maximal_marginal_relevance(query, embeddings, k), number=1, repeat=repeat))
+        vectorized = min(timeit.repeat(
+            lambda: maximal_marginal_relevance(query, embeddings, k), number=1, repeat=repeat))
+        print(f"  fetch_k={fetch_k:4d}  naive {naive * 1000:9.2f} ms  "
+              f"vectorized {vectorized * 1000:7.2f} ms  speedup {naive / vectorized:7.1f}x")
+
+
+def benchmark_score_threshold(candidates=1000, threshold=0.8, repeat=5):
+    """Compare `$match` on score against filtering every candidate on the client.
+
+    MongoDB wire transfer is approximated by BSON encoding on the server side
+    and decoding on the client side of every document that leaves the server.
+    """
+    print(f"Score threshold, candidates={candidates}, threshold={threshold}")
+    docs = [{
+        "title": f"Movie {i}",
+        "fullplot": "plot " * 200,
+        "score": random.uniform(0.5, 1.0),
+    } for i in range(candidates)]
+
+    def transfer(documents):
+        return [bson.decode(bson.encode(doc)) for doc in documents]
+
+    def naive():
+        return [doc for doc in transfer(docs) if doc["score"] >= threshold]
+
+    def pushed_down():
+        return transfer(doc for doc in docs if doc["score"] >= threshold)
+
+    assert naive() == pushed_down()
+    transferred = sum(len(bson.encode(doc)) for doc in docs)
+    transferred_pushed_down = sum(len(bson.encode(doc)) for doc in docs if doc["score"] >= threshold)
+    naive_time = min(timeit.repeat(naive, number=1, repeat=repeat))
+    pushed_down_time = min(timeit.repeat(pushed_down, number=1, repeat=repeat))
+    print(f"  client loop  {naive_time * 1000:7.2f} ms  {transferred / 1024:8.1f} KiB transferred")
+    print(f"  $match       {pushed_down_time * 1000:7.2f} ms  {transferred_pushed_down / 1024:8.1f} KiB transferred")
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    np.random.seed(0)
+    benchmark_mmr()
+    benchmark_score_threshold()
@@ -0,0 +1,83 @@
+"""Check of the failover of `OllamaBackendPool` against fake Ollama servers.
+
+A failing backend must be retried on the other backend, ejected and readmitted once it
+responds again, and equally loaded backends must share the requests.
+
+Run from the project root:
+    python -m misc.check_llm_pool
+"""
+import time
+
+from misc.fakes import FakeOllamaServer
+from rag.llm_pool import NoHealthyBackendError, OllamaBackendPool, PooledOllama
+
+EJECT_SECONDS = 0.5
+
+
+def check(condition: bool, message: str) -> None:
+    print(f"  {'ok  ' if condition else 'FAIL'} {message}")
+    if not condition:
+        raise SystemExit(1)
+
+
+def check_balancing(servers):
+    print("Equally loaded backends")
+    llm = PooledOllama(pool=OllamaBackendPool([server.url for server in servers]), model="fake")
+    for _ in range(20):
+        llm.invoke("prompt")
+    counts = [server.generations for server in servers]
+    check(counts == [10, 10], f"share sequential requests, {counts[0]}/{counts[1]}")
+
+
+def check_failover(servers):
+    print("Failing backend")
+    healthy, failing = servers
+    failing.failing = True
+    sent = failing.generations
+    pool = OllamaBackendPool([failing.url, healthy.url], eject_seconds=EJECT_SECONDS)
+    llm = PooledOllama(pool=pool, model="fake")
+    answers = [llm.invoke("prompt") for _ in range(10)]
+    check(all(answer == healthy.response for answer in answers), "requests are retried on the other backend")
+    check(not pool.backends[0].healthy, "failing backend is ejected")
+    sent = failing.generations - sent
+    check(sent == 1, f"ejected backend gets no requests after the failed one, {sent} sent")
+
+    print("Recovered backend")
+    failing.failing = False
+    time.sleep(EJECT_SECONDS)
+    llm.invoke("prompt")
+    check(pool.backends[0].healthy, "backend is readmitted after a passing health check")
+    before = failing.generations
+    for _ in range(10):
+        llm.invoke("prompt")
+    check(failing.generations - before == 5, f"readmitted backend gets requests, {failing.generations - before} sent")
+
+    print("All backends failing")
+    for server in servers:
+        server.failing = True
+    try:
+        llm.invoke("prompt")
+        check(False, "raises NoHealthyBackendError")
+    except NoHealthyBackendError:
+        check(True, "raises NoHealthyBackendError")
+    check(not any(backend.healthy for backend in pool.backends), "all backends are ejected")
+
+    print("Periodic health checks")
+    servers[1].failing = False
+    health = pool.check_health()
+    check(health == {servers[0].url: False, servers[1].url: True},
+          "readmit responding and eject failing backends without requests")
+
+
+def main():
+    servers = [FakeOllamaServer(latency=0.005).start() for _ in range(2)]
+    try:
+        check_balancing(servers)
+        check_failover(servers)
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Side-by-side comparison of the current and candidate embedding versions before cutover.
+
+Every query of a JSONL query log is searched with both versions, alternating which one runs
+first. The search latency (query embedding and aggregation) of each version and the overlap
+of their top-k results are reported.
+
+Run from the project root, with both versions configured in the .env file:
+    python -m misc.compare_embeddings --log requests.jsonl --queries 200 --k 10
+"""
+import argparse
+import json
+import time
+from statistics import mean
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from misc.load_test import percentile
+from rag.embedding_versions import CANDIDATE, CURRENT
+from rag.warmup import top_queries
+
+# Only `_id` identifies the returned documents
+ID_PROJECTION = {"$project": {"_id": 1, "score": 1}}
+
+
+def compare(queries: List[str], k: int = 10) -> Dict:
+    """Search every query with both embedding versions.
+
+    Returns:
+        Latency percentiles per version and the overlap of the results.
+    """
+    from rag import rag_setup
+
+    if rag_setup.EMBEDDING_ROUTER.candidate is None:
+        raise ValueError("No candidate embedding version configured, set CANDIDATE_EMBEDDING_KEY")
+    vectorstores = {name: rag_setup.projection_vectorstore(name) for name in (CURRENT, CANDIDATE)}
+    for vectorstore in vectorstores.values():
+        # Loads the models and opens connections before anything is measured
+        vectorstore.similarity_search_with_score("warm-up", k=1, custom_projection=ID_PROJECTION)
+
+    latencies = {name: [] for name in vectorstores}
+    overlaps, top1_matches = [], 0
+    for i, query in enumerate(queries):
+        names = (CURRENT, CANDIDATE) if i % 2 == 0 else (CANDIDATE, CURRENT)
+        results = {}
+        for name in names:
+            start = time.perf_counter()
+            docs = vectorstores[name].similarity_search_with_score(query, k=k, custom_projection=ID_PROJECTION)
+            latencies[name].append(time.perf_counter() - start)
+            results[name] = [doc.page_content for doc, _ in docs]
+        current, candidate = results[CURRENT], results[CANDIDATE]
+        overlaps.append(len(set(current) & set(candidate)) / k)
+        top1_matches += bool(current and candidate and current[0] == candidate[0])
+
+    summary = {}
+    for name, values in latencies.items():
+        values.sort()
+        summary[name] = {
+            **rag_setup.EMBEDDING_ROUTER.get(name).describe(),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    summary["overlap"] = {
+        "queries": len(queries),
+        "k": k,
+        "mean_overlap": mean(overlaps) if overlaps else 0.0,
+        "min_overlap": min(overlaps) if overlaps else 0.0,
+        "top1_agreement": top1_matches / len(queries) if queries else 0.0,
+    }
+    return summary
+
+
+def print_summary(summary: Dict) -> None:
+    print(f"{'version':<11}{'model':<45}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in (CURRENT, CANDIDATE):
+        row = summary[name]
+        print(f"{name:<11}{row['model_name']:<45}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+    overlap = summary["overlap"]
+    print(f"\n{overlap['queries']} queries, top-{overlap['k']} overlap: mean {overlap['mean_overlap']:.1%}, "
+          f"min {overlap['min_overlap']:.1%}, top-1 agreement {overlap['top1_agreement']:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default="requests.jsonl", help="JSONL query log the queries are taken from.")
+    parser.add_argument("--queries", type=int, default=100, help="Number of most frequent queries compared.")
+    parser.add_argument("--k", type=int, default=10, help="Number of documents compared per query.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    args = parser.parse_args()
+
+    # Loaded before `compare` imports `rag_setup`, which reads the versions at import
+    load_dotenv()
+    summary = compare(top_queries(args.log, args.queries), k=args.k)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Local stand-ins for MongoDB and Ollama with configurable latency and failures.
+
+Used to run the API without external services, e.g. by `misc/load_test.py`.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.llms import LLM
+
+
+def _sleep(latency: float, spike_latency: float = 0.0, spike_rate: float = 0.0) -> None:
+    if spike_rate and random.random() < spike_rate:
+        time.sleep(spike_latency)
+    elif latency:
+        time.sleep(latency)
+
+
+class FakeCursor:
+    """Aggregation cursor over a list of documents."""
+
+    def __init__(self, docs: List[Dict]):
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict:
+        return next(self._docs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._docs = iter(())
+
+
+class FakeCollection:
+    """MongoDB collection answering `$vectorSearch` aggregations with generated movies.
+
+    Only the `limit` of the `$vectorSearch` stage, `$match` stages on `score`, field references
+    in `$set` stages and `$project` stages of plain field names are interpreted, all other stages are ignored.
+
+    Args:
+        latency: (Optional) seconds every aggregation takes. Defaults to 0.
+        spike_latency: (Optional) seconds a latency spike takes. Defaults to 0.
+        spike_rate: (Optional) fraction of aggregations hitting a latency spike. Defaults to 0.
+        embedding_key: (Optional) field the document embeddings are stored in. Defaults to "embedding".
+        embedding_size: (Optional) size of the document embeddings. Defaults to 384.
+    """
+
+    def __init__(self, latency: float = 0.0, spike_latency: float = 0.0, spike_rate: float = 0.0,
+                 embedding_key: str = "embedding", embedding_size: int = 384):
+        self.latency = latency
+        self.spike_latency = spike_latency
+        self.spike_rate = spike_rate
+        self.embedding_key = embedding_key
+        self.embedding_size = embedding_size
+        self.aggregations = 0
+
+    def with_options(self, **kwargs: Any) -> "FakeCollection":
+        """Return independent collection with the same latencies, standing in for another replica."""
+        return FakeCollection(self.latency, self.spike_latency, self.spike_rate, self.embedding_key,
+                              self.embedding_size)
+
+    def aggregate(self, pipeline: List[Dict], **kwargs: Any) -> FakeCursor:
+        self.aggregations += 1
+        _sleep(self.latency, self.spike_latency, self.spike_rate)
+        limit = pipeline[0]["$vectorSearch"]["limit"]
+        docs = [{
+            "_id": i,
+            "title": f"Movie {i}",
+            "year": 1990 + i % 30,
+            "fullplot": "A movie about " + " ".join(random.choices(["space", "love", "crime", "war"], k=20)),
+            "score": 1.0 - i / (limit + 1),
+            self.embedding_key: [random.gauss(0, 1) for _ in range(self.embedding_size)],
+        } for i in range(limit)]
+        for stage in pipeline[1:]:
+            if "$match" in stage and "score" in stage["$match"]:
+                docs = [doc for doc in docs if doc["score"] >= stage["$match"]["score"]["$gte"]]
+            elif "$set" in stage:
+                for doc in docs:
+                    for field, value in stage["$set"].items():
+                        if isinstance(value, str) and value.startswith("$"):
+                            doc[field] = doc.get(value[1:])
+            elif "$project" in stage:
+                projection = stage["$project"]
+                included = [field for field, value in projection.items() if value not in (0, False)]
+                if included:
+                    fields = set(included) | ({"_id"} if projection.get("_id", 1) else set())
+                    docs = [{field: doc[field] for field in fields if field in doc} for doc in docs]
+                    continue
+                for doc in docs:
+                    for field in projection:
+                        doc.pop(field, None)
+        return FakeCursor(docs)
+
+
+class FakeLLM(LLM):
+    """LLM returning a fixed response after a configurable latency."""
+
+    response: str = "This is a generated answer."
+    latency: float = 0.0
+    spike_latency: float = 0.0
+    spike_rate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        _sleep(self.latency, self.spike_latency, self.spike_rate)
+        return self.response
+
+
+class FakeEncoderEmbeddings(DeterministicFakeEmbedding):
+    """Embedding model costing a fixed latency per forward pass and a smaller latency per text.
+
+    Forward passes run one at a time, like a model using all CPU cores for every pass.
+
+    Args:
+        size: Size of the embeddings.
+        call_latency: (Optional) seconds every forward pass takes. Defaults to 0.004.
+        text_latency: (Optional) additional seconds every text of a pass takes. Defaults to 0.0002.
+    """
+
+    call_latency: float = 0.004
+    text_latency: float = 0.0002
+    _device_lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._device_lock:
+            time.sleep(self.call_latency + self.text_latency * len(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+# Response of the query constructor without any filters
+NO_FILTER_RESPONSE = json.dumps({"query": "movie", "filter": "NO_FILTER"})
+
+
+class FakeOllamaServer:
+    """Local HTTP server implementing `/api/generate` and `/api/tags` of Ollama.
+
+    Args:
+        response: (Optional) text generated for every prompt.
+        latency: (Optional) seconds every generation takes. Defaults to 0.
+        spike_latency: (Optional) seconds a latency spike takes. Defaults to 0.
+        spike_rate: (Optional) fraction of generations hitting a latency spike. Defaults to 0.
+        failing: (Optional) respond with 503 to every request. Defaults to False.
+    """
+
+    def __init__(self, response: str = "This is a generated answer.", latency: float = 0.0,
+                 spike_latency: float = 0.0, spike_rate: float = 0.0, failing: bool = False):
+        self.response = response
+        self.latency = latency
+        self.spike_latency = spike_latency
+        self.spike_rate = spike_rate
+        self.failing = failing
+        self.generations = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def _send(self, status: int, body: str) -> None:
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                self._send(503 if server.failing else 200, json.dumps({"models": []}))
+
+            def do_POST(self) -> None:
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.generations += 1
+                _sleep(server.latency, server.spike_latency, server.spike_rate)
+                if server.failing:
+                    self._send(503, "unavailable")
+                    return
+                self._send(200, json.dumps({"response": server.response, "done": True}) + "\n")
+
+        return Handler
+
+    def start(self) -> "FakeOllamaServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,232 @@
+"""Closed-loop load generator replaying a JSONL query log against the API.
+
+Every line of the query log is a JSON object with a `query` (or `title`) field and optionally
+`endpoint`, `projection` and `docs_num` fields. Lines without `endpoint` are sent to an endpoint
+drawn from the configured mix.
+
+Run against a deployment:
+    python -m misc.load_test --url http://localhost:5000 --log requests.jsonl --concurrency 8
+
+Run against a locally started app wired to fake MongoDB and LLM stand-ins:
+    python -m misc.load_test --local --log requests.jsonl --concurrency 8 --duration 30
+"""
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+ENDPOINTS = ["vector-search", "rag", "sq-vector-search", "sq-rag"]
+
+
+def load_queries(path: str) -> List[Dict]:
+    """Return queries of a JSONL query log."""
+    queries = []
+    with open(path, encoding="utf-8") as log:
+        for line in log:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            query = entry.get("query") or entry.get("title")
+            if not query:
+                continue
+            queries.append({"query": query, **{key: entry[key] for key in ("endpoint", "projection", "docs_num")
+                                                 if key in entry}})
+    if not queries:
+        raise ValueError(f"No queries found in {path}")
+    return queries
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """Return endpoints and their weights from `endpoint=weight,...`."""
+    weights = []
+    for item in mix.split(","):
+        endpoint, _, weight = item.partition("=")
+        endpoint = endpoint.strip().strip("/")
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {endpoint}, expected one of {ENDPOINTS}")
+        weights.append((endpoint, float(weight or 1)))
+    return weights
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Return nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return math.nan
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def start_local_app(mongo_latency: float, llm_latency: float, filter_llm_latency: float,
+                    fake_embeddings: bool) -> str:
+    """Start the app in a background thread with MongoDB and LLMs replaced by fakes.
+
+    Returns:
+        Base URL of the started app.
+    """
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from misc.fakes import NO_FILTER_RESPONSE, FakeCollection, FakeLLM
+
+    os.environ.setdefault("EMBEDDING_KEY", "embedding")
+    if fake_embeddings:
+        # Read when `rag_setup` is imported, before the embedding models are loaded
+        os.environ["FAKE_EMBEDDINGS"] = "true"
+    from rag import rag_setup
+
+    collection = FakeCollection(latency=mongo_latency, embedding_key=os.environ["EMBEDDING_KEY"])
+    rag_setup.mongo_connection = lambda: collection
+    rag_setup.LLM = FakeLLM(latency=llm_latency)
+    rag_setup.JSON_LLM = FakeLLM(response=NO_FILTER_RESPONSE, latency=filter_llm_latency)
+
+    from app import app
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def run(base_url: str, queries: List[Dict], mix: List[Tuple[str, float]], concurrency: int = 4,
+        rate: Optional[float] = None, duration: Optional[float] = 10.0, max_requests: Optional[int] = None,
+        timeout: float = 60.0, seed: int = 0) -> Tuple[Dict[str, Dict], float]:
+    """Replay queries with `concurrency` closed-loop workers.
+
+    Each worker sends its next request when the previous one finished. With `rate`, requests
+    are additionally paced to a target number of requests per second.
+
+    Returns:
+        Latencies and error counts per endpoint, and the elapsed time in seconds.
+    """
+    endpoints, weights = zip(*mix)
+    rng = random.Random(seed)
+    plan_lock = threading.Lock()
+    results = {endpoint: {"latencies": [], "errors": 0} for endpoint in ENDPOINTS}
+    sent = 0
+    start = time.perf_counter()
+
+    def next_request():
+        nonlocal sent
+        with plan_lock:
+            if max_requests is not None and sent >= max_requests:
+                return None
+            if duration is not None and time.perf_counter() - start >= duration:
+                return None
+            entry = queries[sent % len(queries)]
+            endpoint = entry.get("endpoint", "").strip("/") or rng.choices(endpoints, weights)[0]
+            scheduled = start + sent / rate if rate else None
+            sent += 1
+        return entry, endpoint, scheduled
+
+    def worker():
+        session = requests.Session()
+        while True:
+            planned = next_request()
+            if planned is None:
+                return
+            entry, endpoint, scheduled = planned
+            if scheduled is not None:
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+            params = {key: entry[key] for key in ("query", "projection", "docs_num") if key in entry}
+            request_start = time.perf_counter()
+            try:
+                response = session.get(f"{base_url}/{endpoint}", params=params, timeout=timeout)
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            latency = time.perf_counter() - request_start
+            with plan_lock:
+                if failed:
+                    results[endpoint]["errors"] += 1
+                else:
+                    results[endpoint]["latencies"].append(latency)
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results: Dict[str, Dict], elapsed: float) -> Dict[str, Dict]:
+    """Return throughput, latency percentiles and error rate per endpoint and in total."""
+    summary = {}
+    all_latencies, all_errors = [], 0
+    for endpoint, result in results.items():
+        latencies = sorted(result["latencies"])
+        all_latencies.extend(latencies)
+        all_errors += result["errors"]
+        total = len(latencies) + result["errors"]
+        if total:
+            summary[endpoint] = _summary(latencies, result["errors"], elapsed)
+    summary["total"] = _summary(sorted(all_latencies), all_errors, elapsed)
+    return summary
+
+
+def _summary(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def print_summary(summary: Dict[str, Dict]) -> None:
+    print(f"{'endpoint':<18}{'requests':>10}{'errors':>8}{'err %':>8}{'req/s':>9}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, row in summary.items():
+        print(f"{endpoint:<18}{row['requests']:>10}{row['errors']:>8}{row['error_rate'] * 100:>8.1f}"
+              f"{row['throughput']:>9.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the API.")
+    parser.add_argument("--log", default="requests.jsonl", help="JSONL query log to replay.")
+    parser.add_argument("--mix", default="vector-search=1,rag=1,sq-vector-search=1,sq-rag=1",
+                        help="Weighted endpoint mix, e.g. vector-search=3,rag=1.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of closed-loop workers.")
+    parser.add_argument("--rate", type=float, help="Target requests per second across all workers.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run for.")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout of a single request in seconds.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the endpoint mix.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    parser.add_argument("--local", action="store_true",
+                        help="Start the app locally with fake MongoDB and LLM stand-ins instead of using --url.")
+    parser.add_argument("--mongo-latency", type=float, default=0.02, help="Latency of the fake MongoDB.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Latency of the fake answer LLM.")
+    parser.add_argument("--filter-llm-latency", type=float, default=0.3, help="Latency of the fake filter LLM.")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Replace the embedding model with a fake one in --local mode.")
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.local:
+        base_url = start_local_app(args.mongo_latency, args.llm_latency, args.filter_llm_latency,
+                                   args.fake_embeddings)
+    results, elapsed = run(base_url, load_queries(args.log), parse_mix(args.mix), concurrency=args.concurrency,
+                           rate=args.rate, duration=args.duration, max_requests=args.requests,
+                           timeout=args.timeout, seed=args.seed)
+    summary = summarize(results, elapsed)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Bulk maintenance commands for cloning and cleaning up MongoDB collections.
+
+Clones run server-side with `$out` or `$merge`, so documents never pass through the client.
+When server-side output is not available, e.g. for a target on another cluster or without
+the required privileges, documents are copied client-side in batches of bounded size.
+
+A target with a vector search index is always written with `$merge`, which keeps the
+collection and updates its index only for the written documents, while `$out` replaces
+the collection and rebuilds the index.
+
+Run from the project root, with the connection configured in the .env file:
+    python -m misc.maintenance clone movies_copy
+    python -m misc.maintenance clone movies_recent --filter '{"year": {"$gte": 2000}}'
+    python -m misc.maintenance copy-embeddings movies_vectors
+    python -m misc.maintenance delete --filter '{"year": 1993}' --dry-run
+"""
+import argparse
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo import InsertOne, MongoClient, ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+load_dotenv()
+
+# Handling of documents already present in the target, named after `whenMatched` of `$merge`
+ON_EXISTING = ("replace", "merge", "keepExisting")
+
+
+def _projection(fields: Optional[Sequence[str]]) -> Optional[Dict]:
+    return {field: 1 for field in fields} if fields else None
+
+
+def has_search_index(collection: Collection) -> bool:
+    """Return whether the collection has an Atlas Search or Vector Search index."""
+    try:
+        return any(True for _ in collection.list_search_indexes())
+    except OperationFailure:
+        # Not an Atlas deployment, so there are no search indexes
+        return False
+
+
+def _is_empty(collection: Collection) -> bool:
+    return collection.find_one({}, {"_id": 1}) is None
+
+
+def _batches(collection: Collection, query: Dict, projection: Optional[Dict],
+             batch_size: int) -> Iterator[List[Dict]]:
+    """Yield documents matching the query in lists of at most `batch_size` documents."""
+    batch = []
+    with collection.find(query, projection, batch_size=batch_size) as cursor:
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _write_operation(document: Dict, on_existing: Optional[str]):
+    if on_existing is None:
+        return InsertOne(document)
+    if on_existing == "replace":
+        return ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+    fields = {key: value for key, value in document.items() if key != "_id"}
+    if on_existing == "merge":
+        return UpdateOne({"_id": document["_id"]}, {"$set": fields}, upsert=True)
+    return UpdateOne({"_id": document["_id"]}, {"$setOnInsert": fields}, upsert=True)
+
+
+def _clone_client_side(source: Collection, target: Collection, query: Dict, fields: Optional[Sequence[str]],
+                       on_existing: Optional[str], batch_size: int, pause: float) -> int:
+    total = source.count_documents(query)
+    copied = 0
+    for batch in _batches(source, query, _projection(fields), batch_size):
+        target.bulk_write([_write_operation(document, on_existing) for document in batch], ordered=False)
+        copied += len(batch)
+        print(f"Copied {copied}/{total} documents")
+        if pause:
+            time.sleep(pause)
+    return copied
+
+
+def _clone_server_side(source: Collection, target: Collection, query: Dict, fields: Optional[Sequence[str]],
+                       on_existing: Optional[str]) -> None:
+    pipeline = [{"$match": query}]
+    if fields:
+        pipeline.append({"$project": _projection(fields)})
+    into = {"db": target.database.name, "coll": target.name}
+    if on_existing is None:
+        pipeline.append({"$out": into})
+    else:
+        pipeline.append({"$merge": {"into": into, "on": "_id", "whenMatched": on_existing,
+                                    "whenNotMatched": "insert"}})
+    # $out and $merge return no documents, the cursor only has to be exhausted
+    with source.aggregate(pipeline, allowDiskUse=True) as cursor:
+        for _ in cursor:
+            pass
+
+
+def clone_collection(source: Collection, target: Collection, query: Optional[Dict] = None,
+                     fields: Optional[Sequence[str]] = None, on_existing: str = "replace",
+                     client_side: bool = False, batch_size: int = 1000, pause: float = 0.0) -> None:
+    """Copy documents matching the query from source to target collection.
+
+    An empty target without a search index is created with `$out`. Otherwise `$merge` writes
+    into the existing target, keeping its other documents and its vector search index.
+
+    Args:
+        source: Collection the documents are copied from.
+        target: Collection the documents are copied to.
+        query: (Optional) filter of the copied documents. Defaults to None, which copies all documents.
+        fields: (Optional) fields copied besides `_id`. Defaults to None, which copies whole documents.
+        on_existing: (Optional) handling of documents already present in the target, one of
+            "replace", "merge" or "keepExisting". Defaults to "replace".
+        client_side: (Optional) whether to copy the documents through the client even when
+            server-side output is available. Defaults to False.
+        batch_size: (Optional) number of documents held and written at once by a client-side copy.
+            Defaults to 1000.
+        pause: (Optional) seconds to wait between batches of a client-side copy. Defaults to 0.
+    """
+    if on_existing not in ON_EXISTING:
+        raise ValueError(f"on_existing must be one of {ON_EXISTING}, got {on_existing}")
+    if source.full_name == target.full_name:
+        raise ValueError("Source and target collections must differ.")
+    query = query or {}
+    # Writing new documents needs neither upserts nor a search index rebuild
+    replaceable = _is_empty(target) and not has_search_index(target)
+    mode = None if replaceable else on_existing
+    same_cluster = source.database.client is target.database.client
+
+    if same_cluster and not client_side:
+        try:
+            _clone_server_side(source, target, query, fields, mode)
+            print(f"Cloned '{source.full_name}' to '{target.full_name}' server-side "
+                  f"with {'$out' if mode is None else '$merge'}")
+            return
+        except OperationFailure as e:
+            print("An error occurred:", e)
+            print("Falling back to a client-side copy")
+    copied = _clone_client_side(source, target, query, fields, mode, batch_size, pause)
+    print(f"Cloned {copied} documents from '{source.full_name}' to '{target.full_name}'")
+
+
+def copy_embeddings(source: Collection, target: Collection, embedding_key: str, query: Optional[Dict] = None,
+                    **kwargs) -> None:
+    """Copy only the `_id` and embedding field of documents, merging them into existing target documents.
+
+    Args:
+        source: Collection the embeddings are copied from.
+        target: Collection the embeddings are copied to.
+        embedding_key: Field holding the embeddings.
+        query: (Optional) filter of the copied documents. Defaults to None, which copies all embeddings.
+        **kwargs: Keyword arguments passed to `clone_collection`.
+    """
+    kwargs.setdefault("on_existing", "merge")
+    query = {"$and": [query or {}, {embedding_key: {"$exists": True}}]}
+    clone_collection(source, target, query, fields=[embedding_key], **kwargs)
+
+
+def delete_documents(collection: Collection, query: Dict, batch_size: int = 1000, dry_run: bool = False,
+                     pause: float = 0.0) -> int:
+    """Delete documents matching the query in batches, reporting the progress.
+
+    Every batch deletes documents by their `_id` and the query, so documents changed
+    since they were read are only deleted when they still match.
+
+    Args:
+        collection: Collection the documents are deleted from.
+        query: Filter of the deleted documents.
+        batch_size: (Optional) number of documents deleted at once. Defaults to 1000.
+        dry_run: (Optional) whether to only count the matching documents. Defaults to False.
+        pause: (Optional) seconds to wait between batches. Defaults to 0.
+
+    Returns:
+        Number of deleted documents, or of matching documents for a dry run.
+    """
+    total = collection.count_documents(query)
+    if dry_run:
+        batches = -(-total // batch_size)
+        print(f"Dry run: {total} documents match and would be deleted in {batches} batches")
+        return total
+
+    deleted = 0
+    for batch in _batches(collection, query, {"_id": 1}, batch_size):
+        ids = [document["_id"] for document in batch]
+        result = collection.delete_many({"$and": [query, {"_id": {"$in": ids}}]})
+        deleted += result.deleted_count
+        print(f"Deleted {deleted}/{total} documents")
+        if pause:
+            time.sleep(pause)
+    print(f"Deleted {deleted} documents.")
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--collection", default=os.getenv("COLL_NAME"),
+                        help="Source collection of clones, or collection to delete from. Defaults to COLL_NAME.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Documents held and written at once by client-side copies and deletes.")
+    parser.add_argument("--pause", type=float, default=0.0, help="Seconds to wait between batches.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, description in (("clone", "Copy documents to another collection."),
+                              ("copy-embeddings", "Copy only the embedding field to another collection.")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("target", help="Target collection.")
+        command.add_argument("--target-db", default=os.getenv("DB_NAME"), help="Target database. Defaults to DB_NAME.")
+        command.add_argument("--target-uri", help="Connection string of a target on another cluster.")
+        command.add_argument("--filter", default="{}", help="Extended JSON filter of the copied documents.")
+        command.add_argument("--on-existing", choices=ON_EXISTING,
+                             help="Handling of documents already present in the target.")
+        command.add_argument("--client-side", action="store_true", help="Copy documents through the client.")
+    commands.choices["copy-embeddings"].add_argument("--embedding-key", default=os.getenv("EMBEDDING_KEY"),
+                                                     help="Field holding the embeddings. Defaults to EMBEDDING_KEY.")
+
+    delete = commands.add_parser("delete", help="Delete documents in batches.")
+    delete.add_argument("--filter", required=True, help="Extended JSON filter of the deleted documents.")
+    delete.add_argument("--dry-run", action="store_true", help="Only count the matching documents.")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_URI"))
+    target_client = None
+    try:
+        collection = client[os.getenv("DB_NAME")][args.collection]
+        query = json_util.loads(args.filter)
+        if args.command == "delete":
+            delete_documents(collection, query, batch_size=args.batch_size, dry_run=args.dry_run, pause=args.pause)
+            return
+
+        target_client = MongoClient(args.target_uri) if args.target_uri else client
+        target = target_client[args.target_db][args.target]
+        kwargs = {"client_side": args.client_side, "batch_size": args.batch_size, "pause": args.pause}
+        if args.on_existing:
+            kwargs["on_existing"] = args.on_existing
+        if args.command == "clone":
+            clone_collection(collection, target, query, **kwargs)
+        else:
+            copy_embeddings(collection, target, args.embedding_key, query, **kwargs)
+    finally:
+        if target_client is not None and target_client is not client:
+            target_client.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
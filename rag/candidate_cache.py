@@ -0,0 +1,103 @@
+""" In-memory cache of ranked vector search candidates used for pagination
+"""
+import base64
+import binascii
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+class CandidateCache:
+    """Thread-safe LRU cache of ranked candidate lists with TTL and memory limits.
+
+    Entries are JSON-serializable lists of documents. Their size is estimated once from
+    the length of their JSON representation, and least recently used entries are evicted
+    when either `max_entries` or `max_bytes` would be exceeded.
+
+    Args:
+        ttl: (Optional) seconds an entry stays valid after it was stored. Defaults to 300.
+        max_entries: (Optional) maximal number of cached entries. Defaults to 1000.
+        max_bytes: (Optional) maximal estimated size of all cached entries. Defaults to 64 MiB.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        """Estimated size of all cached entries in bytes."""
+        self._entries: "OrderedDict[str, Tuple[float, int, List]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop(self, entry_id: str) -> None:
+        _, size, _ = self._entries.pop(entry_id)
+        self.size -= size
+
+    def _purge_expired(self, now: float) -> None:
+        expired = [entry_id for entry_id, (expires, _, _) in self._entries.items() if expires <= now]
+        for entry_id in expired:
+            self._pop(entry_id)
+
+    def put(self, docs: List) -> Optional[str]:
+        """Store ranked documents.
+
+        Args:
+            docs: JSON-serializable ranked documents.
+
+        Returns:
+            Id of the cache entry, None when the documents alone exceed `max_bytes`.
+        """
+        size = len(json.dumps(docs))
+        if size > self.max_bytes:
+            return None
+        entry_id = secrets.token_urlsafe(12)
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            while self._entries and (len(self._entries) >= self.max_entries or self.size + size > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+            self._entries[entry_id] = (now + self.ttl, size, docs)
+            self.size += size
+        return entry_id
+
+    def get(self, entry_id: str) -> Optional[List]:
+        """Return ranked documents of an entry, None when it does not exist or has expired."""
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return None
+            expires, _, docs = entry
+            if expires <= time.monotonic():
+                self._pop(entry_id)
+                return None
+            self._entries.move_to_end(entry_id)
+            return docs
+
+
+def encode_cursor(entry_id: str, offset: int, page_size: int) -> str:
+    """Return opaque continuation token pointing at `offset` of a cache entry,
+    remembering the page size of the pagination."""
+    payload = json.dumps({"id": entry_id, "offset": offset, "page_size": page_size}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int, int]:
+    """Return cache entry id, offset and page size encoded in a continuation token.
+
+    Raises:
+        ValueError: If the token is malformed.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        entry_id, offset, page_size = payload["id"], int(payload["offset"]), int(payload["page_size"])
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(entry_id, str) or offset < 0 or page_size <= 0:
+        raise ValueError("Malformed cursor")
+    return entry_id, offset, page_size
@@ -0,0 +1,159 @@
+""" Request deadlines propagated through embedding, MongoDB and LLM calls
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import requests
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# Degradation modes of answer generation reported in responses
+DEGRADATION_NONE = "none"
+DEGRADATION_PARTIAL_ANSWER = "partial_answer"
+DEGRADATION_NO_ANSWER = "no_answer"
+
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of the request has passed."""
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]) -> Iterator[None]:
+    """Set the deadline of everything run inside the scope to `seconds` from now.
+
+    The deadline is stored in a context variable, so it is also visible in threads
+    started by LangChain runnables which copy the context.
+    """
+    if seconds is None:
+        yield
+        return
+    token = _DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Return seconds left until the deadline, None when there is no deadline."""
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(stage: str) -> None:
+    """Raise `DeadlineExceeded` when the deadline has passed before `stage`."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+def timeout(default: Optional[float] = None, stage: str = "request") -> Optional[float]:
+    """Return timeout in seconds bounded by the deadline.
+
+    Raises:
+        DeadlineExceeded: If the deadline has already passed.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    check(stage)
+    return left if default is None else min(default, left)
+
+
+def max_time_ms() -> Optional[int]:
+    """Return `maxTimeMS` for MongoDB operations, None when there is no deadline."""
+    left = timeout(stage="aggregation")
+    if left is None:
+        return None
+    return max(1, int(left * 1000))
+
+
+class LatencyEstimate:
+    """Exponentially weighted moving average of a latency.
+
+    Without new samples the estimate halves every `half_life` seconds, so a single slow
+    sample, e.g. of a model being loaded, does not skip the work it estimates for good.
+
+    Args:
+        alpha: (Optional) weight of a new sample. Defaults to 0.2.
+        half_life: (Optional) seconds after which an estimate without new samples halves.
+            Defaults to 60.
+    """
+
+    def __init__(self, alpha: float = 0.2, half_life: float = 60.0):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._seconds = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def seconds(self) -> float:
+        """Current estimate in seconds, decayed since the last sample."""
+        return self._seconds * 0.5 ** ((time.monotonic() - self._updated) / self.half_life)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            current = self.seconds
+            self._seconds = seconds if not current else self.alpha * seconds + (1 - self.alpha) * current
+            self._updated = time.monotonic()
+
+
+GENERATION_LATENCY = LatencyEstimate()
+
+_END = object()
+
+
+def generate_within_deadline(answer_chain: Runnable, inputs: Dict[str, Any],
+                             config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
+    """Return answer generated before the deadline and its degradation mode.
+
+    Generation is skipped when its estimated latency exceeds the remaining time. Otherwise
+    the answer is streamed, and the text generated until the deadline is returned when the
+    deadline passes. An answer whose stream ends right after the deadline is complete.
+
+    Generations cut by the deadline are recorded with the time they ran, which is a lower
+    bound of their latency.
+
+    Args:
+        answer_chain: Chain streaming the answer for `inputs`.
+        inputs: Inputs of the chain.
+        config: (Optional) config of the run.
+
+    Returns:
+        Dictionary with `answer` and `degradation`.
+    """
+    left = remaining()
+    if left is not None and left < GENERATION_LATENCY.seconds:
+        return {"answer": None, "degradation": DEGRADATION_NO_ANSWER}
+
+    start = time.monotonic()
+    chunks = []
+    stream = answer_chain.stream(inputs, config)
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+            left = remaining()
+            if left is not None and left <= 0:
+                # The deadline-bound LLM call fails on its next line when the answer is not finished
+                chunk = next(stream, _END)
+                if chunk is _END:
+                    break
+                chunks.append(chunk)
+                GENERATION_LATENCY.record(time.monotonic() - start)
+                return {"answer": "".join(chunks), "degradation": DEGRADATION_PARTIAL_ANSWER}
+    except (DeadlineExceeded, requests.Timeout):
+        GENERATION_LATENCY.record(time.monotonic() - start)
+        if not chunks:
+            return {"answer": None, "degradation": DEGRADATION_NO_ANSWER}
+        return {"answer": "".join(chunks), "degradation": DEGRADATION_PARTIAL_ANSWER}
+    finally:
+        stream.close()
+    GENERATION_LATENCY.record(time.monotonic() - start)
+    return {"answer": "".join(chunks), "degradation": DEGRADATION_NONE}
@@ -0,0 +1,92 @@
+""" Dynamic micro-batching of concurrent query embeddings
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from rag import deadline
+
+
+class BatchingEmbeddings(Embeddings):
+    """Embeddings collecting concurrent `embed_query` calls into batches.
+
+    Queries are embedded on a dedicated worker thread. After taking the first waiting
+    query, the worker collects more queries for up to `max_wait` seconds or until
+    `max_batch_size` queries are waiting, and embeds all of them with a single
+    `embed_documents` call of the wrapped model. Each caller receives its own vector,
+    so the wrapped model must embed queries and documents alike.
+
+    Args:
+        embedding: Embedding model embedding the batches.
+        max_batch_size: (Optional) maximal number of queries embedded together. Defaults to 32.
+        max_wait: (Optional) maximal seconds the first query of a batch waits for other
+            queries. Defaults to 0.002.
+    """
+
+    def __init__(self, embedding: Embeddings, max_batch_size: int = 32, max_wait: float = 0.002):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.embedding = embedding
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.queries = 0
+        self._queue: "queue.SimpleQueue[Tuple[str, Future]]" = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        """Block until a query is waiting and return it with the queries arriving in time."""
+        batch = [self._queue.get()]
+        wait_until = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            left = wait_until - time.monotonic()
+            try:
+                batch.append(self._queue.get_nowait() if left <= 0 else self._queue.get(timeout=left))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            # Skip queries whose callers stopped waiting, e.g. at their deadline
+            batch = [(text, future) for text, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                vectors = self.embedding.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents directly with the wrapped model, they are batched already."""
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed query together with the queries of concurrent callers.
+
+        Raises:
+            DeadlineExceeded: If the deadline of the request passes before the query is embedded.
+        """
+        timeout = deadline.timeout(stage="embedding")
+        future: Future = Future()
+        self._queue.put((text, future))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise deadline.DeadlineExceeded("Deadline exceeded during embedding")
+
+    @property
+    def average_batch_size(self) -> Optional[float]:
+        """Average number of queries embedded together, None before the first batch."""
+        return self.queries / self.batches if self.batches else None
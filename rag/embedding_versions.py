@@ -0,0 +1,84 @@
+""" Versioned embedding fields and routing of requests between them
+"""
+import hashlib
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+CURRENT = "current"
+CANDIDATE = "candidate"
+
+
+class EmbeddingVersion:
+    """Embedding model together with the document field and the vector search index of its embeddings.
+
+    Args:
+        name: Name of the version requests are routed by.
+        model_name: Name of the embedding model.
+        embedding_key: Document field holding the embeddings of the model.
+        index_name: Vector search index over `embedding_key`.
+        embedding: Embedding model embedding the queries.
+    """
+
+    def __init__(self, name: str, model_name: str, embedding_key: str, index_name: str, embedding: Embeddings):
+        self.name = name
+        self.model_name = model_name
+        self.embedding_key = embedding_key
+        self.index_name = index_name
+        self.embedding = embedding
+
+    def describe(self) -> Dict:
+        return {"model_name": self.model_name, "embedding_key": self.embedding_key, "index_name": self.index_name}
+
+
+class EmbeddingRouter:
+    """Routes requests between the current embedding version and a candidate being migrated to.
+
+    A request may ask for a version by its name. Other requests are routed to the candidate
+    by the hash of their query, so a query is always served by the same version.
+
+    Args:
+        current: Version serving the requests.
+        candidate: (Optional) version being migrated to. Defaults to None.
+        candidate_percent: (Optional) percentage of queries routed to the candidate. Defaults to 0.
+    """
+
+    def __init__(self, current: EmbeddingVersion, candidate: Optional[EmbeddingVersion] = None,
+                 candidate_percent: float = 0.0):
+        self.versions = {current.name: current}
+        if candidate is not None:
+            self.versions[candidate.name] = candidate
+        self.current = current
+        self.candidate = candidate
+        self.candidate_percent = candidate_percent
+
+    def get(self, name: Optional[str] = None) -> EmbeddingVersion:
+        """Return version by its name, the current version when no name is given.
+
+        Raises:
+            ValueError: If there is no version with the name.
+        """
+        if name is None:
+            return self.current
+        if name not in self.versions:
+            raise ValueError(f"Unknown embedding version {name}, expected one of {list(self.versions)}")
+        return self.versions[name]
+
+    def route(self, query: Optional[str], requested: Optional[str] = None) -> EmbeddingVersion:
+        """Return version serving the query, the requested one when given.
+
+        Raises:
+            ValueError: If the requested version does not exist.
+        """
+        if requested:
+            return self.get(requested)
+        if self.candidate is None or self.candidate_percent <= 0:
+            return self.current
+        bucket = int(hashlib.sha256((query or "").encode()).hexdigest()[:8], 16) % 10000 / 100
+        return self.candidate if bucket < self.candidate_percent else self.current
+
+    def embedding_keys(self) -> List[str]:
+        """Return document fields holding embeddings of all versions."""
+        return [version.embedding_key for version in self.versions.values() if version.embedding_key]
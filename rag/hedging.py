@@ -0,0 +1,164 @@
+""" Hedged requests reducing tail latency of MongoDB and LLM calls
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """Runs a call and, when it has not returned within a percentile of its recent
+    latencies, a duplicate call. The first successful result is used. The other call is
+    cancelled when it has not started yet, a running call is not interrupted and its
+    result is discarded when it arrives.
+
+    Latencies are kept separately for every `key` of the calls, so calls of different
+    shapes, e.g. small and large queries, are hedged by their own percentile.
+
+    The extra load is limited by a token bucket earning `budget` hedges per call and
+    holding at most `burst` hedges.
+
+    Args:
+        percentile: (Optional) percentile of recent latencies after which a call is hedged.
+            Defaults to 95.
+        budget: (Optional) maximal ratio of hedged calls to all calls. Defaults to 0.05.
+        burst: (Optional) maximal number of hedges saved up for bursts. Defaults to 10.
+        min_samples: (Optional) number of latencies recorded before calls are hedged.
+            Defaults to 20.
+        window: (Optional) number of recent latencies of a key the percentile is computed
+            from. Defaults to 1000.
+        max_workers: (Optional) number of threads running duplicate calls. Defaults to 32.
+
+    The primary call runs on the caller's thread while no hedge is possible, otherwise on
+    a thread of its own, so the number of concurrent calls is not limited by the pool and
+    the hedge delay is not spent waiting for a free worker.
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, burst: float = 10.0,
+                 min_samples: int = 20, window: int = 1000, max_workers: int = 32):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedger")
+
+    def delay(self, key: Hashable = None) -> Optional[float]:
+        """Return seconds after which calls with the key are hedged, None while too few
+        of their latencies are known."""
+        with self._lock:
+            if len(self._latencies[key]) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies[key])
+        index = max(0, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return latencies[index]
+
+    def _record(self, key: Hashable, seconds: float) -> None:
+        with self._lock:
+            self._latencies[key].append(seconds)
+
+    def _earn_token(self) -> None:
+        with self._lock:
+            self.calls += 1
+            self._tokens = min(self._tokens + self.budget, self.burst)
+
+    def _has_token(self) -> bool:
+        with self._lock:
+            return self._tokens >= 1.0
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            self.hedged += 1
+            return True
+
+    def _timed(self, call: Callable[[], T], key: Hashable) -> Callable[[], T]:
+        def timed_call() -> T:
+            start = time.monotonic()
+            result = call()
+            self._record(key, time.monotonic() - start)
+            return result
+
+        return timed_call
+
+    def _submit(self, call: Callable[[], T]) -> Future:
+        # Runs in the context of the caller, so the request deadline and callbacks are kept
+        return self._executor.submit(contextvars.copy_context().run, call)
+
+    def run(self, call: Callable[[], T], hedge: Optional[Callable[[], T]] = None,
+            discard: Optional[Callable[[T], Any]] = None, key: Hashable = None) -> T:
+        """Return result of `call`, or of `hedge` when it returns first.
+
+        Args:
+            call: Primary call.
+            hedge: (Optional) duplicate call, e.g. to another replica. Defaults to `call`.
+            discard: (Optional) function releasing the result of the losing call,
+                e.g. closing a cursor or a response.
+            key: (Optional) shape of the call its latencies are kept under. Defaults to None.
+
+        Returns:
+            Result of the call which successfully returned first.
+        """
+        self._earn_token()
+        delay = self.delay(key)
+        if delay is None or not self._has_token():
+            return self._timed(call, key)()
+
+        primary = _start_thread(self._timed(call, key))
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_token():
+            return primary.result()
+
+        secondary = self._submit(hedge or call)
+        pending = {primary, secondary}
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                for loser in (pending | done) - {future}:
+                    if not loser.cancel() and discard is not None:
+                        loser.add_done_callback(_discard_result(discard))
+                if future is secondary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+        raise errors[0]
+
+
+def _start_thread(call: Callable[[], T]) -> Future:
+    """Run the call in the context of the caller on a new thread and return its future."""
+    future = Future()
+    future.set_running_or_notify_cancel()
+    context = contextvars.copy_context()
+
+    def target() -> None:
+        try:
+            future.set_result(context.run(call))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name="hedger-primary", daemon=True).start()
+    return future
+
+
+def _discard_result(discard: Callable[[Any], Any]) -> Callable[[Future], None]:
+    def callback(future: Future) -> None:
+        if future.exception() is None:
+            discard(future.result())
+
+    return callback
@@ -0,0 +1,327 @@
+""" Load-balanced pool of Ollama backends with keep-alive connections
+"""
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_community.llms.ollama import Ollama, OllamaEndpointNotFoundError
+from rag import deadline
+from rag.hedging import Hedger
+
+
+class NoHealthyBackendError(Exception):
+    """Raised when every backend of the pool is ejected or failing."""
+
+
+class OllamaBackend:
+    """Single Ollama endpoint with its persistent HTTP session and load statistics."""
+
+    def __init__(self, base_url: str, pool_maxsize: int = 10):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.outstanding = 0
+        """Number of requests currently in flight."""
+        self.consecutive_failures = 0
+        self.ejected_until: Optional[float] = None
+        """Monotonic time after which an ejected backend is health-checked again."""
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until is None
+
+
+class OllamaBackendPool:
+    """Pool of Ollama backends routing each request to the backend with the
+    least outstanding requests, taking turns between equally loaded backends.
+
+    Backends failing `max_failures` times in a row are ejected. After `eject_seconds`
+    an ejected backend is health-checked on the next request and readmitted if it responds.
+    With `start_health_checks`, all backends are instead health-checked periodically on a
+    background thread, so failing backends are ejected before requests are routed to them
+    and requests never wait for a health check.
+
+    Args:
+        endpoints: Base URLs of the Ollama backends.
+        max_failures: (Optional) consecutive failures after which a backend is ejected.
+            Defaults to 1.
+        eject_seconds: (Optional) time an ejected backend is excluded from routing.
+            Defaults to 30.
+        health_check_timeout: (Optional) timeout of a single health check in seconds.
+            Defaults to 2.
+        pool_maxsize: (Optional) number of persistent connections kept per backend.
+            Defaults to 10.
+        hedger: (Optional) hedger duplicating slow requests to another backend.
+            Defaults to None.
+    """
+
+    def __init__(
+            self,
+            endpoints: Sequence[str],
+            max_failures: int = 1,
+            eject_seconds: float = 30.0,
+            health_check_timeout: float = 2.0,
+            pool_maxsize: int = 10,
+            hedger: Optional[Hedger] = None,
+    ):
+        if not endpoints:
+            raise ValueError("OllamaBackendPool requires at least one endpoint.")
+        self.backends = [OllamaBackend(endpoint, pool_maxsize) for endpoint in endpoints]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_check_timeout = health_check_timeout
+        self.hedger = hedger
+        self._next = 0
+        self._health_check_thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env_value(cls, value: str, **kwargs: Any) -> "OllamaBackendPool":
+        """Return pool for a comma separated list of endpoints."""
+        return cls([endpoint.strip() for endpoint in value.split(",") if endpoint.strip()], **kwargs)
+
+    def _probe(self, backend: OllamaBackend) -> bool:
+        try:
+            response = backend.session.get(f"{backend.base_url}/api/tags", timeout=self.health_check_timeout)
+        except requests.RequestException:
+            return False
+        return response.status_code == 200
+
+    def _record_success(self, backend: OllamaBackend) -> None:
+        with self._lock:
+            backend.consecutive_failures = 0
+            backend.ejected_until = None
+
+    def _record_failure(self, backend: OllamaBackend) -> None:
+        with self._lock:
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.max_failures:
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def _revive_expired(self) -> None:
+        """Health-check ejected backends whose ejection time has passed."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [b for b in self.backends if not b.healthy and b.ejected_until <= now]
+            # Claim the backends, so concurrent requests do not probe them again
+            for backend in expired:
+                backend.ejected_until = now + self.eject_seconds
+        for backend in expired:
+            if self._probe(backend):
+                self._record_success(backend)
+
+    def check_health(self) -> Dict[str, bool]:
+        """Health-check all backends, ejecting failing and readmitting responding ones.
+
+        Returns:
+            Health of every backend by its base URL.
+        """
+        health = {}
+        for backend in self.backends:
+            if self._probe(backend):
+                self._record_success(backend)
+            else:
+                with self._lock:
+                    backend.ejected_until = time.monotonic() + self.eject_seconds
+            health[backend.base_url] = backend.healthy
+        return health
+
+    def start_health_checks(self, interval: float) -> threading.Thread:
+        """Run `check_health` every `interval` seconds on a background thread, starting now."""
+        def run() -> None:
+            while True:
+                try:
+                    self.check_health()
+                except Exception as e:
+                    print("An error occurred:", e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="ollama-health-check", daemon=True)
+        thread.start()
+        self._health_check_thread = thread
+        return thread
+
+    def _acquire(self, tried: List[OllamaBackend]) -> OllamaBackend:
+        with self._lock:
+            # Rotating the order makes `min` take turns between equally loaded backends
+            start = self._next % len(self.backends)
+            self._next += 1
+            ordered = self.backends[start:] + self.backends[:start]
+            candidates = [b for b in ordered if b.healthy and b not in tried]
+            if not candidates:
+                raise NoHealthyBackendError("No healthy Ollama backend available.")
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            tried.append(backend)
+            return backend
+
+    def _release(self, backend: OllamaBackend) -> None:
+        with self._lock:
+            backend.outstanding -= 1
+
+    def _open(self, path: str, tried: List[OllamaBackend], kwargs: Dict[str, Any]
+              ) -> Tuple[OllamaBackend, requests.Response]:
+        """Send request to the least loaded backend not tried yet, retrying failing backends.
+
+        The returned backend counts as outstanding until it is released.
+        """
+        while True:
+            backend = self._acquire(tried)
+            try:
+                response = backend.session.post(f"{backend.base_url}{path}", stream=True, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._release(backend)
+                left = deadline.remaining()
+                if left is not None and left <= 0:
+                    # The request ran out of time, the backend is not to blame
+                    raise deadline.DeadlineExceeded("Deadline exceeded during LLM call")
+                self._record_failure(backend)
+                continue
+            if response.status_code >= 500:
+                response.close()
+                self._release(backend)
+                self._record_failure(backend)
+                continue
+            self._record_success(backend)
+            return backend, response
+
+    def _discard(self, opened: Tuple[OllamaBackend, requests.Response]) -> None:
+        backend, response = opened
+        response.close()
+        self._release(backend)
+
+    def post_lines(self, path: str, **kwargs: Any) -> Iterator[str]:
+        """POST request to the least loaded backend and yield lines of the response.
+
+        Connection errors, timeouts and 5xx responses are retried on the remaining
+        healthy backends. With a hedger, a slow request is duplicated to another backend
+        and the response arriving later is closed. The backend counts as outstanding
+        until the response is consumed.
+
+        Args:
+            path: Path of the Ollama API, e.g. `/api/generate`.
+            **kwargs: Keyword arguments passed to `requests.Session.post`.
+
+        Yields:
+            Decoded lines of the response body.
+        """
+        if self._health_check_thread is None:
+            # Without periodic health checks, ejected backends are probed on the request path
+            self._revive_expired()
+        tried: List[OllamaBackend] = []
+        if self.hedger is None:
+            backend, response = self._open(path, tried, kwargs)
+        else:
+            backend, response = self.hedger.run(lambda: self._open(path, tried, kwargs), discard=self._discard)
+        try:
+            with response:
+                if response.status_code == 404:
+                    raise OllamaEndpointNotFoundError(
+                        f"Ollama call to {backend.base_url} failed with status code 404. "
+                        "Maybe your model is not found.")
+                if response.status_code != 200:
+                    raise ValueError(
+                        f"Ollama call failed with status code {response.status_code}."
+                        f" Details: {response.text}")
+                response.encoding = "utf-8"
+                yield from response.iter_lines(decode_unicode=True)
+        finally:
+            self._release(backend)
+
+
+class DeadlineOllama(Ollama):
+    """Ollama LLM whose requests time out at the deadline of the current request."""
+
+    def _post_lines(self, api_url: str, **kwargs: Any) -> Iterator[str]:
+        """POST request to the Ollama API and return lines of the response."""
+        response = requests.post(url=api_url, stream=True, **kwargs)
+        response.encoding = "utf-8"
+        if response.status_code != 200:
+            if response.status_code == 404:
+                raise OllamaEndpointNotFoundError(
+                    "Ollama call failed with status code 404. "
+                    "Maybe your model is not found "
+                    f"and you should pull the model with `ollama pull {self.model}`."
+                )
+            else:
+                optional_detail = response.text
+                raise ValueError(
+                    f"Ollama call failed with status code {response.status_code}."
+                    f" Details: {optional_detail}"
+                )
+        return response.iter_lines(decode_unicode=True)
+
+    def _create_stream(
+            self,
+            api_url: str,
+            payload: Any,
+            stop: Optional[List[str]] = None,
+            **kwargs: Any,
+    ) -> Iterator[str]:
+        if self.stop is not None and stop is not None:
+            raise ValueError("`stop` found in both the input and default params.")
+        elif self.stop is not None:
+            stop = self.stop
+
+        params = self._default_params
+
+        for key in self._default_params:
+            if key in kwargs:
+                params[key] = kwargs[key]
+
+        if "options" in kwargs:
+            params["options"] = kwargs["options"]
+        else:
+            params["options"] = {
+                **params["options"],
+                "stop": stop,
+                **{k: v for k, v in kwargs.items() if k not in self._default_params},
+            }
+
+        if payload.get("messages"):
+            request_payload = {"messages": payload.get("messages", []), **params}
+        else:
+            request_payload = {
+                "prompt": payload.get("prompt"),
+                "images": payload.get("images", []),
+                **params,
+            }
+        lines = self._post_lines(
+            api_url,
+            headers={
+                "Content-Type": "application/json",
+                **(self.headers if isinstance(self.headers, dict) else {}),
+            },
+            auth=self.auth,
+            json=request_payload,
+            timeout=deadline.timeout(self.timeout, stage="LLM call"),
+        )
+        # Read timeouts apply to single chunks, the deadline is checked for every streamed line
+        for line in lines:
+            deadline.check("end of LLM call")
+            yield line
+
+
+class PooledOllama(DeadlineOllama):
+    """Ollama LLM sending its synchronous requests through `OllamaBackendPool`
+    instead of the single `base_url`."""
+
+    pool: OllamaBackendPool
+    """Pool of backends the requests are routed to."""
+
+    class Config:
+        """Configuration for this pydantic object."""
+
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-ollama"
+
+    def _post_lines(self, api_url: str, **kwargs: Any) -> Iterator[str]:
+        return self.pool.post_lines(urlparse(api_url).path, **kwargs)
@@ -0,0 +1,60 @@
+""" Vectorized Maximal Marginal Relevance selection
+"""
+from typing import List, Sequence
+
+import numpy as np
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Return matrix with rows scaled to unit length, zero rows are left unchanged."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def maximal_marginal_relevance(
+        query_embedding: Sequence[float],
+        embeddings: Sequence[Sequence[float]],
+        k: int = 4,
+        lambda_mult: float = 0.5,
+) -> List[int]:
+    """Return indexes of embeddings selected using the maximal marginal relevance.
+
+    Cosine similarities to the query are computed once for all candidates. After each
+    selection only the similarities to the newly selected embedding are computed, and
+    the running maximum similarity to the selected set is updated in place, so every
+    step is a single matrix-vector product instead of a loop over candidates.
+
+    Args:
+        query_embedding: Embedded query.
+        embeddings: Embeddings of the candidate documents.
+        k: (Optional) number of documents to select. Defaults to 4.
+        lambda_mult: Number between 0 and 1 that determines the degree
+            of diversity among the results with 0 corresponding
+            to maximum diversity and 1 to minimum diversity.
+            Defaults to 0.5.
+
+    Returns:
+        Indexes of the selected embeddings, in order of selection.
+    """
+    candidates = np.asarray(embeddings, dtype=np.float32)
+    if k <= 0 or candidates.size == 0:
+        return []
+    candidates = _normalize_rows(candidates)
+    query = _normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+
+    query_similarity = candidates @ query
+    max_similarity_to_selected = np.full(len(candidates), -np.inf, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+
+    selected = [int(np.argmax(query_similarity))]
+    available[selected[0]] = False
+    while len(selected) < min(k, len(candidates)):
+        np.maximum(max_similarity_to_selected, candidates @ candidates[selected[-1]],
+                   out=max_similarity_to_selected)
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_similarity_to_selected
+        scores[~available] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        available[index] = False
+    return selected
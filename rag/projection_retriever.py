@@ -1,6 +1,6 @@
 """ Custom MongoDBAtlasProjectionRetriever based on BaseRetriever
 """
-from typing import List
+from typing import Iterator, List, Optional
 from langchain_core.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
 from langchain_core.pydantic_v1 import Field
@@ -13,31 +13,47 @@ class MongoDBAtlasProjectionRetriever(BaseRetriever):
 
     movie_vectorstore: MongoDBAtlasProjectionVectorStore
     """VectorStore to use for retrieval."""
+    search_type: str = "similarity"
+    """Type of search to perform. One of "similarity", "similarity_score_threshold" or "mmr"."""
     search_kwargs: dict = Field(default_factory=dict)
     """Keyword arguments to pass to the search function."""
 
     def _get_relevant_documents(
             self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
-        # docs = list(json.dumps(x) for x in self.movie_vectorstore.similarity_search_with_score(
-        #     query, **self.search_kwargs))
-        # docs = list(x for x in self.movie_vectorstore.similarity_search_with_score(query, **self.search_kwargs))
-        docs_and_similarities = self.movie_vectorstore.similarity_search_with_score(query, **self.search_kwargs)
-        docs = [doc for doc, _ in docs_and_similarities]
-        # if self.search_type == "similarity":
-        #     docs = self.vectorstore.similarity_search(
-        #         query, **self.search_kwargs)
-        # elif self.search_type == "similarity_score_threshold":
-        #     docs_and_similarities = (
-        #         self.vectorstore.similarity_search_with_relevance_scores(
-        #             query, **self.search_kwargs
-        #         )
-        #     )
-        #     docs = [doc for doc, _ in docs_and_similarities]
-        # elif self.search_type == "mmr":
-        #     docs = self.vectorstore.max_marginal_relevance_search(
-        #         query, **self.search_kwargs
-        #     )
-        # else:
-        #     raise ValueError(f"search_type of {self.search_type} not allowed.")
+        if self.search_type == "similarity":
+            docs_and_similarities = self.movie_vectorstore.similarity_search_with_score(
+                query, **self.search_kwargs)
+            docs = [doc for doc, _ in docs_and_similarities]
+        elif self.search_type == "similarity_score_threshold":
+            docs_and_similarities = self.movie_vectorstore.similarity_search_with_relevance_scores(
+                query, **self.search_kwargs)
+            docs = [doc for doc, _ in docs_and_similarities]
+        elif self.search_type == "mmr":
+            docs = self.movie_vectorstore.max_marginal_relevance_search(
+                query, **self.search_kwargs)
+        else:
+            raise ValueError(f"search_type of {self.search_type} not allowed.")
         return docs
+
+    def stream_relevant_documents(self, query: str, batch_size: Optional[int] = None) -> Iterator[Document]:
+        """Yield documents relevant for a query while they are read from MongoDB.
+
+        Args:
+            query: string to find relevant documents for
+            batch_size: (Optional) number of documents fetched from MongoDB
+                per cursor batch.
+
+        Yields:
+            Relevant documents
+        """
+        if self.search_type == "mmr":
+            # MMR needs all candidates before the first document can be selected
+            yield from self.movie_vectorstore.max_marginal_relevance_search(query, **self.search_kwargs)
+            return
+        if self.search_type not in ("similarity", "similarity_score_threshold"):
+            raise ValueError(f"search_type of {self.search_type} not allowed.")
+        docs_and_similarities = self.movie_vectorstore.stream_similarity_search_with_score(
+            query, batch_size=batch_size, **self.search_kwargs)
+        for doc, _ in docs_and_similarities:
+            yield doc
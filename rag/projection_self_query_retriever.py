@@ -1,7 +1,9 @@
 """Retriever that generates and executes structured queries over its own data source."""
 
 import logging
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, Union
+from functools import lru_cache
+from importlib import import_module
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
 
 from langchain_core.callbacks.manager import (
     AsyncCallbackManagerForRetrieverRun,
@@ -11,149 +13,102 @@ from langchain_core.documents import Document
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.pydantic_v1 import Field, root_validator
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableConfig
 from langchain_core.structured_query import StructuredQuery, Visitor
 from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores.mongodb_atlas import MongoDBAtlasVectorSearch
 
 from langchain.chains.query_constructor.base import load_query_constructor_runnable
 from langchain.chains.query_constructor.schema import AttributeInfo
+from rag.query_cache import LRUCache
 
 logger = logging.getLogger(__name__)
 QUERY_CONSTRUCTOR_RUN_NAME = "query_constructor"
 
 
-def _get_builtin_translator(vectorstore: VectorStore) -> Visitor:
-    """Get the translator class corresponding to the vector store class."""
-    try:
-        import langchain_community  # noqa: F401
-    except ImportError:
-        raise ImportError(
-            "The langchain-community package must be installed to use this feature."
-            " Please install it using `pip install langchain-community`."
-        )
+def _translator(module: str, name: str, factory: Optional[Callable] = None) -> Callable[[VectorStore], Visitor]:
+    """Return factory of a translator imported only when the factory is first called.
 
-    from langchain_community.query_constructors.astradb import AstraDBTranslator
-    from langchain_community.query_constructors.chroma import ChromaTranslator
-    from langchain_community.query_constructors.dashvector import DashvectorTranslator
-    from langchain_community.query_constructors.databricks_vector_search import (
-        DatabricksVectorSearchTranslator,
-    )
-    from langchain_community.query_constructors.deeplake import DeepLakeTranslator
-    from langchain_community.query_constructors.dingo import DingoDBTranslator
-    from langchain_community.query_constructors.elasticsearch import (
-        ElasticsearchTranslator,
-    )
-    from langchain_community.query_constructors.milvus import MilvusTranslator
-    from langchain_community.query_constructors.mongodb_atlas import (
-        MongoDBAtlasTranslator,
-    )
-    from langchain_community.query_constructors.myscale import MyScaleTranslator
-    from langchain_community.query_constructors.opensearch import OpenSearchTranslator
-    from langchain_community.query_constructors.pgvector import PGVectorTranslator
-    from langchain_community.query_constructors.pinecone import PineconeTranslator
-    from langchain_community.query_constructors.qdrant import QdrantTranslator
-    from langchain_community.query_constructors.redis import RedisTranslator
-    from langchain_community.query_constructors.supabase import SupabaseVectorTranslator
-    from langchain_community.query_constructors.tencentvectordb import (
-        TencentVectorDBTranslator,
-    )
-    from langchain_community.query_constructors.timescalevector import (
-        TimescaleVectorTranslator,
-    )
-    from langchain_community.query_constructors.vectara import VectaraTranslator
-    from langchain_community.query_constructors.weaviate import WeaviateTranslator
-    from langchain_community.vectorstores import (
-        AstraDB,
-        Chroma,
-        DashVector,
-        DatabricksVectorSearch,
-        DeepLake,
-        Dingo,
-        Milvus,
-        MongoDBAtlasVectorSearch,
-        MyScale,
-        OpenSearchVectorSearch,
-        PGVector,
-        Qdrant,
-        Redis,
-        SupabaseVectorStore,
-        TencentVectorDB,
-        TimescaleVector,
-        Vectara,
-        Weaviate,
-    )
-    from langchain_community.vectorstores import (
-        ElasticsearchStore as ElasticsearchStoreCommunity,
-    )
-    from langchain_community.vectorstores import (
-        Pinecone as CommunityPinecone,
+    Args:
+        module: Module of `langchain_community.query_constructors` defining the translator.
+        name: Name of the translator class.
+        factory: (Optional) function creating the translator from its class and the vector store.
+            Defaults to calling the class without arguments.
+    """
+    def create(vectorstore: VectorStore) -> Visitor:
+        translator_cls = getattr(import_module(f"langchain_community.query_constructors.{module}"), name)
+        if factory is None:
+            return translator_cls()
+        return factory(translator_cls, vectorstore)
+
+    return create
+
+
+# Translator factories keyed by top-level package and name of the vector store class
+BUILTIN_TRANSLATORS: Dict[Tuple[str, str], Callable[[VectorStore], Visitor]] = {
+    ("langchain_community", "AstraDB"): _translator("astradb", "AstraDBTranslator"),
+    ("langchain_community", "PGVector"): _translator("pgvector", "PGVectorTranslator"),
+    ("langchain_community", "Pinecone"): _translator("pinecone", "PineconeTranslator"),
+    ("langchain_community", "Chroma"): _translator("chroma", "ChromaTranslator"),
+    ("langchain_community", "DashVector"): _translator("dashvector", "DashvectorTranslator"),
+    ("langchain_community", "Dingo"): _translator("dingo", "DingoDBTranslator"),
+    ("langchain_community", "Weaviate"): _translator("weaviate", "WeaviateTranslator"),
+    ("langchain_community", "Vectara"): _translator("vectara", "VectaraTranslator"),
+    ("langchain_community", "DeepLake"): _translator("deeplake", "DeepLakeTranslator"),
+    ("langchain_community", "ElasticsearchStore"): _translator("elasticsearch", "ElasticsearchTranslator"),
+    ("langchain_community", "Milvus"): _translator("milvus", "MilvusTranslator"),
+    ("langchain_community", "SupabaseVectorStore"): _translator("supabase", "SupabaseVectorTranslator"),
+    ("langchain_community", "TimescaleVector"): _translator("timescalevector", "TimescaleVectorTranslator"),
+    ("langchain_community", "OpenSearchVectorSearch"): _translator("opensearch", "OpenSearchTranslator"),
+    ("langchain_community", "MongoDBAtlasVectorSearch"): _translator("mongodb_atlas", "MongoDBAtlasTranslator"),
+    ("langchain_community", "DatabricksVectorSearch"): _translator(
+        "databricks_vector_search", "DatabricksVectorSearchTranslator"),
+    ("langchain_community", "Qdrant"): _translator(
+        "qdrant", "QdrantTranslator", lambda cls, vs: cls(metadata_key=vs.metadata_payload_key)),
+    ("langchain_community", "MyScale"): _translator(
+        "myscale", "MyScaleTranslator", lambda cls, vs: cls(metadata_key=vs.metadata_column)),
+    ("langchain_community", "Redis"): _translator(
+        "redis", "RedisTranslator", lambda cls, vs: cls.from_vectorstore(vs)),
+    ("langchain_community", "TencentVectorDB"): _translator(
+        "tencentvectordb", "TencentVectorDBTranslator",
+        lambda cls, vs: cls([field.name for field in (vs.meta_fields or []) if field.index])),
+    ("langchain_astradb", "AstraDBVectorStore"): _translator("astradb", "AstraDBTranslator"),
+    ("langchain_elasticsearch", "ElasticsearchStore"): _translator("elasticsearch", "ElasticsearchTranslator"),
+    ("langchain_pinecone", "PineconeVectorStore"): _translator("pinecone", "PineconeTranslator"),
+}
+
+
+@lru_cache(maxsize=None)
+def _mongodb_atlas_translator() -> Visitor:
+    """Return shared translator of MongoDB Atlas vector stores, the translator holds no state."""
+    from langchain_community.query_constructors.mongodb_atlas import MongoDBAtlasTranslator
+
+    return MongoDBAtlasTranslator()
+
+
+@lru_cache(maxsize=None)
+def _resolve_translator_factory(vectorstore_cls: Type[VectorStore]) -> Callable[[VectorStore], Visitor]:
+    """Return translator factory of the closest vector store class in the MRO."""
+    for cls in vectorstore_cls.__mro__:
+        factory = BUILTIN_TRANSLATORS.get((cls.__module__.split(".")[0], cls.__name__))
+        if factory is not None:
+            return factory
+    raise ValueError(
+        f"Self query retriever with Vector Store type {vectorstore_cls}"
+        f" not supported."
     )
 
-    BUILTIN_TRANSLATORS: Dict[Type[VectorStore], Type[Visitor]] = {
-        AstraDB: AstraDBTranslator,
-        PGVector: PGVectorTranslator,
-        CommunityPinecone: PineconeTranslator,
-        Chroma: ChromaTranslator,
-        DashVector: DashvectorTranslator,
-        Dingo: DingoDBTranslator,
-        Weaviate: WeaviateTranslator,
-        Vectara: VectaraTranslator,
-        Qdrant: QdrantTranslator,
-        MyScale: MyScaleTranslator,
-        DeepLake: DeepLakeTranslator,
-        ElasticsearchStoreCommunity: ElasticsearchTranslator,
-        Milvus: MilvusTranslator,
-        SupabaseVectorStore: SupabaseVectorTranslator,
-        TimescaleVector: TimescaleVectorTranslator,
-        OpenSearchVectorSearch: OpenSearchTranslator,
-        MongoDBAtlasVectorSearch: MongoDBAtlasTranslator,
-    }
-    if isinstance(vectorstore, DatabricksVectorSearch):
-        return DatabricksVectorSearchTranslator()
-    if isinstance(vectorstore, Qdrant):
-        return QdrantTranslator(metadata_key=vectorstore.metadata_payload_key)
-    elif isinstance(vectorstore, MyScale):
-        return MyScaleTranslator(metadata_key=vectorstore.metadata_column)
-    elif isinstance(vectorstore, Redis):
-        return RedisTranslator.from_vectorstore(vectorstore)
-    elif isinstance(vectorstore, MongoDBAtlasVectorSearch):
-        return MongoDBAtlasTranslator()
-    elif isinstance(vectorstore, TencentVectorDB):
-        fields = [
-            field.name for field in (vectorstore.meta_fields or []) if field.index
-        ]
-        return TencentVectorDBTranslator(fields)
-    elif vectorstore.__class__ in BUILTIN_TRANSLATORS:
-        return BUILTIN_TRANSLATORS[vectorstore.__class__]()
-    else:
-        try:
-            from langchain_astradb.vectorstores import AstraDBVectorStore
-        except ImportError:
-            pass
-        else:
-            if isinstance(vectorstore, AstraDBVectorStore):
-                return AstraDBTranslator()
-
-        try:
-            from langchain_elasticsearch.vectorstores import ElasticsearchStore
-        except ImportError:
-            pass
-        else:
-            if isinstance(vectorstore, ElasticsearchStore):
-                return ElasticsearchTranslator()
-
-        try:
-            from langchain_pinecone import PineconeVectorStore
-        except ImportError:
-            pass
-        else:
-            if isinstance(vectorstore, PineconeVectorStore):
-                return PineconeTranslator()
-
-        raise ValueError(
-            f"Self query retriever with Vector Store type {vectorstore.__class__}"
-            f" not supported."
-        )
+
+def _get_builtin_translator(vectorstore: VectorStore) -> Visitor:
+    """Get the translator class corresponding to the vector store class.
+
+    MongoDB Atlas vector stores get the shared `MongoDBAtlasTranslator` directly. For other
+    vector stores the translator is looked up in `BUILTIN_TRANSLATORS` by the classes of the
+    vector store, and only the matching translator module is imported.
+    """
+    if isinstance(vectorstore, MongoDBAtlasVectorSearch):
+        return _mongodb_atlas_translator()
+    return _resolve_translator_factory(type(vectorstore))(vectorstore)
 
 
 class SelfQueryRetriever(BaseRetriever):
@@ -176,6 +131,8 @@ class SelfQueryRetriever(BaseRetriever):
 
     use_original_query: bool = False
     """Use original query instead of the revised new query from LLM"""
+    structured_query_cache: Optional[LRUCache] = None
+    """Cache of structured queries by query, usually shared between retrievers."""
 
     class Config:
         """Configuration for this pydantic object."""
@@ -197,6 +154,28 @@ class SelfQueryRetriever(BaseRetriever):
         """llm_chain is legacy name kept for backwards compatibility."""
         return self.query_constructor
 
+    def construct_query(self, query: str, config: Optional[RunnableConfig] = None) -> StructuredQuery:
+        """Return structured query generated for a query, from `structured_query_cache` when cached."""
+        if self.structured_query_cache is not None:
+            structured_query = self.structured_query_cache.get(query)
+            if structured_query is not None:
+                return structured_query
+        structured_query = self.query_constructor.invoke({"query": query}, config=config)
+        if self.structured_query_cache is not None:
+            self.structured_query_cache.put(query, structured_query)
+        return structured_query
+
+    async def aconstruct_query(self, query: str, config: Optional[RunnableConfig] = None) -> StructuredQuery:
+        """Return structured query generated for a query, from `structured_query_cache` when cached."""
+        if self.structured_query_cache is not None:
+            structured_query = self.structured_query_cache.get(query)
+            if structured_query is not None:
+                return structured_query
+        structured_query = await self.query_constructor.ainvoke({"query": query}, config=config)
+        if self.structured_query_cache is not None:
+            self.structured_query_cache.put(query, structured_query)
+        return structured_query
+
     def _prepare_query(
             self, query: str, structured_query: StructuredQuery
     ) -> Tuple[str, Dict[str, Any]]:
@@ -233,8 +212,8 @@ class SelfQueryRetriever(BaseRetriever):
         Returns:
             List of relevant documents
         """
-        structured_query = self.query_constructor.invoke(
-            {"query": query}, config={"callbacks": run_manager.get_child()}
+        structured_query = self.construct_query(
+            query, config={"callbacks": run_manager.get_child()}
         )
         if self.verbose:
             logger.info(f"Generated Query: {structured_query}")
@@ -242,6 +221,35 @@ class SelfQueryRetriever(BaseRetriever):
         docs = self._get_docs_with_query(new_query, search_kwargs)
         return docs
 
+    def stream_relevant_documents(
+            self, query: str, batch_size: Optional[int] = None
+    ) -> Iterator[Document]:
+        """Yield documents relevant for a query while they are read from the vector store.
+
+        The structured query is generated up front, documents are then streamed
+        from `stream_similarity_search_with_score` of the vector store.
+
+        Args:
+            query: string to find relevant documents for
+            batch_size: (Optional) number of documents fetched per cursor batch
+
+        Yields:
+            Relevant documents
+        """
+        structured_query = self.construct_query(query)
+        if self.verbose:
+            logger.info(f"Generated Query: {structured_query}")
+        new_query, search_kwargs = self._prepare_query(query, structured_query)
+        if self.search_type == "mmr":
+            # MMR needs all candidates before the first document can be selected
+            yield from self._get_docs_with_query(new_query, search_kwargs)
+            return
+        docs_and_similarities = self.vectorstore.stream_similarity_search_with_score(
+            new_query, batch_size=batch_size, **search_kwargs
+        )
+        for doc, _ in docs_and_similarities:
+            yield doc
+
     async def _aget_relevant_documents(
             self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
     ) -> List[Document]:
@@ -253,8 +261,8 @@ class SelfQueryRetriever(BaseRetriever):
         Returns:
             List of relevant documents
         """
-        structured_query = await self.query_constructor.ainvoke(
-            {"query": query}, config={"callbacks": run_manager.get_child()}
+        structured_query = await self.aconstruct_query(
+            query, config={"callbacks": run_manager.get_child()}
         )
         if self.verbose:
             logger.info(f"Generated Query: {structured_query}")
@@ -3,6 +3,7 @@
 from typing import (
     Any,
     Dict,
+    Iterator,
     List,
     Optional,
     Tuple,
@@ -10,26 +11,95 @@ from typing import (
 )
 from langchain_community.vectorstores import MongoDBAtlasVectorSearch
 from langchain_core.documents import Document
+from rag import deadline
+from rag.hedging import Hedger
+from rag.mmr import maximal_marginal_relevance
 
 MongoDBDocumentType = TypeVar("MongoDBDocumentType", bound=Dict[str, Any])
 
+# Temporary field carrying document embeddings through custom projections for MMR
+MMR_EMBEDDING_FIELD = "__mmr_embedding"
+
+# Maximal `numCandidates` of a `$vectorSearch` stage accepted by Atlas
+MAX_NUM_CANDIDATES = 10000
+
+
+def _keep_field_in_projection(stage: Dict, field: str) -> Dict:
+    """Return aggregation stage that does not drop `field`.
+
+    Inclusion `$project` stages are extended with `field`, all other stages are returned unchanged.
+    """
+    projection = stage.get("$project")
+    if not isinstance(projection, dict):
+        return stage
+    if all(value in (0, False) for key, value in projection.items() if key != "_id"):
+        return stage
+    return {"$project": {**projection, field: 1}}
+
+
+def _query_shape(pipeline: List[Dict], aggregate_kwargs: Dict) -> Tuple:
+    """Return shape of a vector search aggregation its latencies are hedged by.
+
+    Searches are told apart by MMR fetching the embeddings, pre-filtering, and by the cursor
+    batch size and the number of returned documents, both rounded up to a power of two.
+    """
+    params = pipeline[0].get("$vectorSearch", {}) if pipeline else {}
+    mmr = any(MMR_EMBEDDING_FIELD in stage.get("$set", {}) for stage in pipeline)
+    return (
+        "mmr" if mmr else "similarity",
+        "filter" in params,
+        (aggregate_kwargs.get("batchSize") or 0).bit_length(),
+        int(params.get("limit", 0)).bit_length(),
+    )
+
 
 class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
     """Modifed `MongoDB Atlas Vector Search` vector store.
     """
 
-    def _similarity_search_with_score(
+    def __init__(
+            self,
+            collection: Any,
+            embedding: Any,
+            *,
+            hedger: Optional[Hedger] = None,
+            hedge_collection: Optional[Any] = None,
+            **kwargs: Any,
+    ):
+        """
+        Args:
+            collection: MongoDB collection to add the texts to.
+            embedding: Text embedding model to use.
+            hedger: (Optional) hedger duplicating slow aggregations. Defaults to None.
+            hedge_collection: (Optional) collection hedged aggregations are sent to,
+                e.g. with a different read preference. Defaults to `collection`.
+            **kwargs: Keyword arguments passed to `MongoDBAtlasVectorSearch`.
+        """
+        super().__init__(collection, embedding, **kwargs)
+        self._hedger = hedger
+        self._hedge_collection = hedge_collection if hedge_collection is not None else collection
+
+    def _aggregate(self, pipeline: List[Dict], **kwargs: Any) -> Any:
+        """Run aggregation, hedged to `hedge_collection` when it is slow and a hedger is set."""
+        if self._hedger is None:
+            return self._collection.aggregate(pipeline, **kwargs)  # type: ignore[arg-type]
+        return self._hedger.run(
+            lambda: self._collection.aggregate(pipeline, **kwargs),  # type: ignore[arg-type]
+            lambda: self._hedge_collection.aggregate(pipeline, **kwargs),
+            discard=lambda cursor: cursor.close(),
+            key=_query_shape(pipeline, kwargs),
+        )
+
+    def _similarity_search_pipeline(
             self,
             embedded_query: List[float],
             k: int = 4,
             pre_filter: Optional[Dict] = None,
             post_filter_pipeline: Optional[List[Dict]] = None,
-            custom_projection: Optional[Dict] = None
-    ) -> List[Tuple[Document, float]]:
-        """Return MongoDB documents most similar to the given query and their scores.
-
-        Uses the vectorSearch operator available in MongoDB Atlas Search.
-        For more: https://www.mongodb.com/docs/atlas/atlas-vector-search/vector-search-stage/
+            custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None
+    ) -> List[Dict]:
+        """Return aggregation pipeline for MongoDB Vector Search.
 
         Args:
             embedded_query: Embedded query to look up documents similar to.
@@ -40,15 +110,17 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
                 following the vectorSearch stage.
             custom_projection: (Optional) Custom document projection returned from
                 the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents,
+                applied as `$match` stage in the aggregation pipeline.
 
         Returns:
-            List of documents most similar to the query and their scores.
+            List of MongoDB aggregation stages.
         """
         params = {
             "index": self._index_name,
             "path": self._embedding_key,
             "queryVector": embedded_query,
-            "numCandidates": k * 10,
+            "numCandidates": min(k * 10, MAX_NUM_CANDIDATES),
             "limit": k,
         }
         if pre_filter:
@@ -60,19 +132,113 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
             {"$set": {"score": {"$meta": "vectorSearchScore"}}},
         ]
 
+        if score_threshold is not None:
+            pipeline.append({"$match": {"score": {"$gte": score_threshold}}})
+
         if custom_projection:
             pipeline.append(custom_projection)
 
         if post_filter_pipeline is not None:
             pipeline.extend(post_filter_pipeline)
 
-        cursor = self._collection.aggregate(pipeline)  # type: ignore[arg-type]
-        docs = []
-        for res in cursor:
-            score = res.pop("score")
-            text = str(res)
-            docs.append((Document(page_content=text), score))
-        return docs
+        return pipeline
+
+    @staticmethod
+    def _aggregate_kwargs() -> Dict[str, Any]:
+        """Return keyword arguments of `aggregate` limiting it to the request deadline."""
+        max_time_ms = deadline.max_time_ms()
+        if max_time_ms is None:
+            return {}
+        return {"maxTimeMS": max_time_ms}
+
+    def _iter_similarity_search_with_score(
+            self,
+            embedded_query: List[float],
+            k: int = 4,
+            pre_filter: Optional[Dict] = None,
+            post_filter_pipeline: Optional[List[Dict]] = None,
+            custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None,
+            batch_size: Optional[int] = None
+    ) -> Iterator[Tuple[Document, float]]:
+        """Yield MongoDB documents most similar to the given query and their scores.
+
+        Documents are yielded one by one while the aggregation cursor is read,
+        so the whole result set is never held in memory.
+
+        Args:
+            embedded_query: Embedded query to look up documents similar to.
+            k: (Optional) number of documents to return. Defaults to 4.
+            pre_filter: (Optional) dictionary of argument(s) to prefilter document
+                fields on.
+            post_filter_pipeline: (Optional) Pipeline of MongoDB aggregation stages
+                following the vectorSearch stage.
+            custom_projection: (Optional) Custom document projection returned from
+                the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents,
+                applied as `$match` stage in the aggregation pipeline.
+            batch_size: (Optional) number of documents fetched from MongoDB
+                per cursor batch. Defaults to the server default.
+
+        Yields:
+            Documents most similar to the query and their scores.
+        """
+        pipeline = self._similarity_search_pipeline(
+            embedded_query,
+            k=k,
+            pre_filter=pre_filter,
+            post_filter_pipeline=post_filter_pipeline,
+            custom_projection=custom_projection,
+            score_threshold=score_threshold,
+        )
+        aggregate_kwargs = self._aggregate_kwargs()
+        if batch_size:
+            aggregate_kwargs["batchSize"] = batch_size
+
+        cursor = self._aggregate(pipeline, **aggregate_kwargs)
+        with cursor:
+            for res in cursor:
+                score = res.pop("score")
+                text = str(res)
+                yield Document(page_content=text), score
+
+    def _similarity_search_with_score(
+            self,
+            embedded_query: List[float],
+            k: int = 4,
+            pre_filter: Optional[Dict] = None,
+            post_filter_pipeline: Optional[List[Dict]] = None,
+            custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None
+    ) -> List[Tuple[Document, float]]:
+        """Return MongoDB documents most similar to the given query and their scores.
+
+        Uses the vectorSearch operator available in MongoDB Atlas Search.
+        For more: https://www.mongodb.com/docs/atlas/atlas-vector-search/vector-search-stage/
+
+        Args:
+            embedded_query: Embedded query to look up documents similar to.
+            k: (Optional) number of documents to return. Defaults to 4.
+            pre_filter: (Optional) dictionary of argument(s) to prefilter document
+                fields on.
+            post_filter_pipeline: (Optional) Pipeline of MongoDB aggregation stages
+                following the vectorSearch stage.
+            custom_projection: (Optional) Custom document projection returned from
+                the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents,
+                applied as `$match` stage in the aggregation pipeline.
+
+        Returns:
+            List of documents most similar to the query and their scores.
+        """
+        return list(self._iter_similarity_search_with_score(
+            embedded_query,
+            k=k,
+            pre_filter=pre_filter,
+            post_filter_pipeline=post_filter_pipeline,
+            custom_projection=custom_projection,
+            score_threshold=score_threshold,
+        ))
 
     def similarity_search_with_score(
             self,
@@ -81,6 +247,7 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
             pre_filter: Optional[Dict] = None,
             post_filter_pipeline: Optional[List[Dict]] = None,
             custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None,
             **kwargs: Any,
     ) -> List[Tuple[Document, float]]:
         """Return MongoDB documents most similar to the given query and their scores.
@@ -97,10 +264,13 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
                 following the vectorSearch stage.
             custom_projection: (Optional) Custom document projection returned from
                 the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents,
+                applied as `$match` stage in the aggregation pipeline.
 
         Returns:
             List of documents most similar to the query and their scores.
         """
+        deadline.check("embedding")
         embedded_query = self._embedding.embed_query(query)
         docs = self._similarity_search_with_score(
             embedded_query,
@@ -108,6 +278,7 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
             pre_filter=pre_filter,
             post_filter_pipeline=post_filter_pipeline,
             custom_projection=custom_projection,
+            score_threshold=score_threshold,
             **kwargs,
         )
         return docs
@@ -149,3 +320,132 @@ class MongoDBAtlasProjectionVectorStore(MongoDBAtlasVectorSearch):
             for doc, score in docs_and_scores:
                 doc.metadata["score"] = score
         return [doc for doc, _ in docs_and_scores]
+
+    def stream_similarity_search_with_score(
+            self,
+            query: str,
+            k: int = 4,
+            pre_filter: Optional[Dict] = None,
+            post_filter_pipeline: Optional[List[Dict]] = None,
+            custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None,
+            batch_size: Optional[int] = None,
+            **kwargs: Any,
+    ) -> Iterator[Tuple[Document, float]]:
+        """Yield MongoDB documents most similar to the given query and their scores.
+
+        Streaming counterpart of `similarity_search_with_score`.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: (Optional) number of documents to return. Defaults to 4.
+            pre_filter: (Optional) dictionary of argument(s) to prefilter document
+                fields on.
+            post_filter_pipeline: (Optional) Pipeline of MongoDB aggregation stages
+                following the vectorSearch stage.
+            custom_projection: (Optional) Custom document projection returned from
+                the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents,
+                applied as `$match` stage in the aggregation pipeline.
+            batch_size: (Optional) number of documents fetched from MongoDB
+                per cursor batch.
+
+        Yields:
+            Documents most similar to the query and their scores.
+        """
+        deadline.check("embedding")
+        embedded_query = self._embedding.embed_query(query)
+        yield from self._iter_similarity_search_with_score(
+            embedded_query,
+            k=k,
+            pre_filter=pre_filter,
+            post_filter_pipeline=post_filter_pipeline,
+            custom_projection=custom_projection,
+            score_threshold=score_threshold,
+            batch_size=batch_size,
+        )
+
+    def similarity_search_with_relevance_scores(
+            self,
+            query: str,
+            k: int = 4,
+            score_threshold: Optional[float] = None,
+            **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return MongoDB documents most similar to the given query and their relevance scores.
+
+        vectorSearchScore is already normalized to [0, 1] by MongoDB Atlas, so it is
+        used as the relevance score and the threshold is applied server side.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: (Optional) number of documents to return. Defaults to 4.
+            score_threshold: (Optional) minimal vectorSearchScore of returned documents.
+
+        Returns:
+            List of documents most similar to the query and their relevance scores.
+        """
+        return self.similarity_search_with_score(
+            query, k=k, score_threshold=score_threshold, **kwargs)
+
+    def max_marginal_relevance_search(
+            self,
+            query: str,
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            pre_filter: Optional[Dict] = None,
+            post_filter_pipeline: Optional[List[Dict]] = None,
+            custom_projection: Optional[Dict] = None,
+            score_threshold: Optional[float] = None,
+            **kwargs: Any,
+    ) -> List[Document]:
+        """Return MongoDB documents selected using the maximal marginal relevance.
+
+        Candidates and their embeddings are fetched in a single aggregation, the
+        embedding is carried through `custom_projection` in a temporary field.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: (Optional) number of documents to return. Defaults to 4.
+            fetch_k: (Optional) number of documents to fetch before passing to MMR
+                algorithm, at least `k` documents are fetched. Defaults to 20.
+            lambda_mult: Number between 0 and 1 that determines the degree
+                of diversity among the results with 0 corresponding
+                to maximum diversity and 1 to minimum diversity.
+                Defaults to 0.5.
+            pre_filter: (Optional) dictionary of argument(s) to prefilter document
+                fields on.
+            post_filter_pipeline: (Optional) Pipeline of MongoDB aggregation stages
+                following the vectorSearch stage.
+            custom_projection: (Optional) Custom document projection returned from
+                the MongoDB collection.
+            score_threshold: (Optional) minimal vectorSearchScore of fetched documents.
+
+        Returns:
+            List of documents selected by maximal marginal relevance.
+        """
+        deadline.check("embedding")
+        embedded_query = self._embedding.embed_query(query)
+        pipeline = self._similarity_search_pipeline(
+            embedded_query,
+            k=max(fetch_k, k),
+            pre_filter=pre_filter,
+            score_threshold=score_threshold,
+        )
+        pipeline.append({"$set": {MMR_EMBEDDING_FIELD: f"${self._embedding_key}"}})
+        if custom_projection:
+            pipeline.append(_keep_field_in_projection(custom_projection, MMR_EMBEDDING_FIELD))
+        if post_filter_pipeline is not None:
+            pipeline.extend(post_filter_pipeline)
+
+        docs = []
+        embeddings = []
+        for res in self._aggregate(pipeline, **self._aggregate_kwargs()):
+            res.pop("score")
+            embeddings.append(res.pop(MMR_EMBEDDING_FIELD))
+            docs.append(Document(page_content=str(res)))
+
+        mmr_doc_indexes = maximal_marginal_relevance(
+            embedded_query, embeddings, k=k, lambda_mult=lambda_mult)
+        return [docs[i] for i in mmr_doc_indexes]
@@ -0,0 +1,69 @@
+""" In-memory caches of query embeddings and self-query translations
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+
+class LRUCache:
+    """Thread-safe cache evicting the least recently used entry beyond `max_entries`.
+
+    Args:
+        max_entries: (Optional) maximal number of cached entries. Defaults to 1000.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return cached value, None when the key is not cached."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings caching the vectors of queries, documents are embedded without caching.
+
+    Args:
+        embedding: Embedding model embedding queries which are not cached.
+        cache: (Optional) cache of query vectors. Defaults to a new `LRUCache`.
+    """
+
+    def __init__(self, embedding: Embeddings, cache: Optional[LRUCache] = None):
+        self.embedding = embedding
+        self.cache = cache if cache is not None else LRUCache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = self.embedding.embed_query(text)
+            self.cache.put(text, vector)
+        # Callers get their own copy, so the cached vector cannot be modified
+        return list(vector)
@@ -1,33 +1,189 @@
 """Collection of functions used to set up RAG infrastructure"""
 import os
 from typing import (
+    Any,
     Dict,
     Optional,
 )
 
 from pymongo import MongoClient
+from pymongo.read_preferences import SecondaryPreferred
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough, RunnableSerializable
+from langchain_core.runnables import (
+    RunnableConfig,
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough,
+    RunnableSerializable,
+)
 from langchain_community.llms.ollama import Ollama
 from langchain.chains.query_constructor.base import AttributeInfo
 from rag.projection_self_query_retriever import SelfQueryRetriever
 from rag.projection_vector_store import MongoDBAtlasProjectionVectorStore
 from rag.projection_retriever import MongoDBAtlasProjectionRetriever
+from rag.llm_pool import DeadlineOllama, OllamaBackendPool, PooledOllama
+from rag.deadline import generate_within_deadline
+from rag.hedging import Hedger
+from rag.embedding_batcher import BatchingEmbeddings
+from rag.query_cache import CachedEmbeddings, LRUCache
+from rag.embedding_versions import (
+    CANDIDATE,
+    CURRENT,
+    DEFAULT_EMBEDDING_MODEL_NAME,
+    EmbeddingRouter,
+    EmbeddingVersion,
+)
 from rag.prompt_template import PROMPT
 
 CLIENT = MongoClient(os.getenv("MONGO_URI"))
 
-EMBEDDING_MODEL = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2")
+# Concurrent query embeddings are batched into a single forward pass, batch size 1 disables batching.
+# Off by default, every batched query waits up to `EMBEDDING_BATCH_WAIT_MS` even without concurrency
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "1"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "2"))
+
+# Number of cached query embeddings, 0 disables caching
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1000"))
+
+
+# Replaces the embedding models by deterministic fakes, e.g. for load tests without the models
+FAKE_EMBEDDINGS = os.getenv("FAKE_EMBEDDINGS", "").lower() in ("1", "true")
+
+
+def query_embedding_model(embedding: Embeddings) -> Embeddings:
+    """Return embedding model batching concurrent queries and caching query embeddings
+    as configured with environment variables.
+
+    Args:
+        embedding: Embedding model embedding the queries.
+
+    Returns:
+        Embedding model wrapped in `BatchingEmbeddings` and `CachedEmbeddings` when enabled.
+    """
+    if EMBEDDING_BATCH_SIZE > 1:
+        embedding = BatchingEmbeddings(
+            embedding, max_batch_size=EMBEDDING_BATCH_SIZE, max_wait=EMBEDDING_BATCH_WAIT_MS / 1000)
+    if QUERY_EMBEDDING_CACHE_SIZE > 0:
+        embedding = CachedEmbeddings(embedding, LRUCache(QUERY_EMBEDDING_CACHE_SIZE))
+    return embedding
+
+
+def embedding_version_from_env(name: str, prefix: str = "") -> Optional[EmbeddingVersion]:
+    """Return embedding version configured with `<prefix>EMBEDDING_MODEL_NAME`,
+    `<prefix>EMBEDDING_KEY` and `<prefix>INDEX_NAME` environment variables.
+
+    Args:
+        name: Name of the version.
+        prefix: (Optional) prefix of the environment variables. Defaults to "".
+
+    Returns:
+        Embedding version, None for a prefixed version without `<prefix>EMBEDDING_KEY`.
+    """
+    embedding_key = os.getenv(f"{prefix}EMBEDDING_KEY")
+    if prefix and not embedding_key:
+        return None
+    model_name = os.getenv(f"{prefix}EMBEDDING_MODEL_NAME") or DEFAULT_EMBEDDING_MODEL_NAME
+    if FAKE_EMBEDDINGS:
+        embedding = DeterministicFakeEmbedding(size=384)
+    else:
+        embedding = HuggingFaceEmbeddings(model_name=model_name)
+    return EmbeddingVersion(name, model_name, embedding_key, os.getenv(f"{prefix}INDEX_NAME"),
+                            query_embedding_model(embedding))
+
+
+# A candidate embedding version is searched for `CANDIDATE_EMBEDDING_PERCENT` of queries before cutover
+EMBEDDING_ROUTER = EmbeddingRouter(
+    embedding_version_from_env(CURRENT),
+    embedding_version_from_env(CANDIDATE, prefix="CANDIDATE_"),
+    candidate_percent=float(os.getenv("CANDIDATE_EMBEDDING_PERCENT") or "0"),
+)
+
+# Number of cached self-query translations, 0 disables caching. The self-querying chains
+# describe the documents differently, so their translations are cached separately
+STRUCTURED_QUERY_CACHE_SIZE = int(os.getenv("STRUCTURED_QUERY_CACHE_SIZE", "1000"))
+VECTOR_SEARCH_STRUCTURED_QUERIES = LRUCache(STRUCTURED_QUERY_CACHE_SIZE)
+RAG_STRUCTURED_QUERIES = LRUCache(STRUCTURED_QUERY_CACHE_SIZE)
+
+
+def hedger_from_env(prefix: str) -> Optional[Hedger]:
+    """Return hedger when hedging is enabled with `<prefix>_HEDGING` environment variable.
+
+    Args:
+        prefix: Prefix of the environment variable, e.g. `MONGO` or `LLM`.
+
+    Returns:
+        Hedger configured with `HEDGE_PERCENTILE` and `HEDGE_BUDGET`, or None.
+    """
+    if os.getenv(f"{prefix}_HEDGING", "").lower() not in ("1", "true"):
+        return None
+    return Hedger(
+        percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+        budget=float(os.getenv("HEDGE_BUDGET", "0.05")),
+    )
+
+
+MONGO_HEDGER = hedger_from_env("MONGO")
+
+
+# Seconds between health checks of pooled Ollama backends, 0 disables them
+OLLAMA_HEALTH_CHECK_INTERVAL = float(os.getenv("OLLAMA_HEALTH_CHECK_INTERVAL") or "10")
+
+
+# Pools by their endpoints, LLMs over the same backends share a pool
+OLLAMA_POOLS: Dict[str, OllamaBackendPool] = {}
+
+
+def ollama_backend_pool(endpoints: str) -> OllamaBackendPool:
+    """Return pool of Ollama backends, the same pool for the same endpoints.
+
+    A shared pool counts the outstanding requests of all LLMs routed to its backends,
+    and health-checks every backend once.
+
+    Args:
+        endpoints: Comma separated base URLs of Ollama backends.
+
+    Returns:
+        `OllamaBackendPool` of the endpoints.
+    """
+    key = ",".join(endpoint.strip().rstrip("/") for endpoint in endpoints.split(",") if endpoint.strip())
+    if key not in OLLAMA_POOLS:
+        pool = OllamaBackendPool.from_env_value(key, hedger=hedger_from_env("LLM"))
+        if OLLAMA_HEALTH_CHECK_INTERVAL > 0:
+            pool.start_health_checks(OLLAMA_HEALTH_CHECK_INTERVAL)
+        OLLAMA_POOLS[key] = pool
+    return OLLAMA_POOLS[key]
+
+
+def ollama_llm(endpoints: Optional[str] = None, **kwargs) -> Ollama:
+    """Return Ollama LLM, load-balanced over a pool of backends when endpoints are given.
+
+    Args:
+        endpoints: (Optional) comma separated base URLs of Ollama backends.
+            Defaults to None, which uses the single default Ollama endpoint.
+        **kwargs: Keyword arguments passed to `Ollama`.
+
+    Returns:
+        Ollama LLM with requests limited by the request deadline.
+    """
+    if not endpoints:
+        return DeadlineOllama(**kwargs)
+    return PooledOllama(pool=ollama_backend_pool(endpoints), **kwargs)
+
 
-LLM = Ollama(model="phi3:3.8b")
+# Answer generation and filter extraction can be routed to different pools
+LLM_ENDPOINTS = os.getenv("OLLAMA_ENDPOINTS")
+JSON_LLM_ENDPOINTS = os.getenv("OLLAMA_FILTER_ENDPOINTS") or LLM_ENDPOINTS
+
+LLM = ollama_llm(LLM_ENDPOINTS, model="phi3:3.8b")
 
 # LLM model with enabled feature to format response into JSON object
-JSON_LLM = Ollama(model="phi3:3.8b", format="json")
+JSON_LLM = ollama_llm(JSON_LLM_ENDPOINTS, model="phi3:3.8b", format="json")
 
 # Document content description for self query vector search
 DOCUMENT_CONTENT_DESCRIPTION = os.getenv("DOCUMENT_CONTENT_DESCRIPTION")
+VECTOR_SEARCH_DOCUMENT_CONTENT_DESCRIPTION = "Brief summary of a movie"
 
 # Metadata required for self query vector search
 METADATA_FIELD_INFO = [
@@ -49,6 +205,19 @@ METADATA_FIELD_INFO = [
 OUTPUT_PARSER = StrOutputParser()
 
 
+def generate_answer(inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+    """Return inputs extended with the answer generated before the request deadline.
+
+    Args:
+        inputs: Dictionary with retrieved `context` and `question`.
+        config: Config of the run.
+
+    Returns:
+        Inputs with `answer` and `degradation` mode of the answer.
+    """
+    return {**inputs, **generate_within_deadline(PROMPT | LLM | OUTPUT_PARSER, inputs, config)}
+
+
 def mongo_connection():
     """Return MongoDB Collection.
 
@@ -64,7 +233,30 @@ def mongo_connection():
     return collection
 
 
-def vector_search_chain(custom_projection: Optional[Dict] = None, k: int = 4) -> MongoDBAtlasProjectionRetriever:
+def projection_vectorstore(embedding_version: Optional[str] = None) -> MongoDBAtlasProjectionVectorStore:
+    """Return vector store of the MongoDB Collection specified in .env file.
+
+    With `MONGO_HEDGING` enabled, slow aggregations are hedged to a secondary replica,
+    or to the primary when the deployment has no secondary available.
+
+    Args:
+        embedding_version: (Optional) name of the embedding version whose model, field
+            and index are searched. Defaults to None, which uses the current version.
+
+    Returns:
+        `MongoDBAtlasProjectionVectorStore` of the collection.
+    """
+    version = EMBEDDING_ROUTER.get(embedding_version)
+    collection = mongo_connection()
+    hedge_collection = collection.with_options(read_preference=SecondaryPreferred()) if MONGO_HEDGER else None
+    return MongoDBAtlasProjectionVectorStore(
+        collection, version.embedding, embedding_key=version.embedding_key, index_name=version.index_name,
+        hedger=MONGO_HEDGER, hedge_collection=hedge_collection)
+
+
+def vector_search_chain(custom_projection: Optional[Dict] = None, k: int = 4,
+        search_type: str = "similarity", search_kwargs: Optional[Dict] = None,
+        embedding_version: Optional[str] = None) -> MongoDBAtlasProjectionRetriever:
     """Return Chain consisting of retriever for MongoDB Vector Search.
 
     Uses `MongoDBAtlasProjectionVectorStore` and `MongoDBAtlasProjectionRetriever`.
@@ -73,21 +265,27 @@ def vector_search_chain(custom_projection: Optional[Dict] = None, k: int = 4) ->
         custom_projection: (Optional) Custom document projection returned from
             the MongoDB collection. Defaults to None.
         k: (Optional) number of documents to return. Defaults to 4.
+        search_type: (Optional) type of search to perform. One of "similarity",
+            "similarity_score_threshold" or "mmr". Defaults to "similarity".
+        search_kwargs: (Optional) additional keyword arguments for the search,
+            e.g. `score_threshold`, `fetch_k` or `lambda_mult`. Defaults to None.
+        embedding_version: (Optional) name of the embedding version to search with.
+            Defaults to None, which uses the current version.
 
     Returns:
         Chain for MongoDB Vector Search.
     """
-    collection = mongo_connection()
-    vectorstore = MongoDBAtlasProjectionVectorStore(
-        collection, EMBEDDING_MODEL, embedding_key=os.getenv("EMBEDDING_KEY"), index_name=os.getenv("INDEX_NAME"))
+    vectorstore = projection_vectorstore(embedding_version)
 
-    retriever = MongoDBAtlasProjectionRetriever(movie_vectorstore=vectorstore, search_kwargs={
-        "custom_projection": custom_projection, "k": k})
+    retriever = MongoDBAtlasProjectionRetriever(movie_vectorstore=vectorstore, search_type=search_type, search_kwargs={
+        "custom_projection": custom_projection, "k": k, **(search_kwargs or {})})
 
     return retriever
 
 
-def rag_chain(custom_projection: Optional[Dict] = None, k: int = 4) -> RunnableSerializable[str, str]:
+def rag_chain(custom_projection: Optional[Dict] = None, k: int = 4,
+        search_type: str = "similarity", search_kwargs: Optional[Dict] = None,
+        embedding_version: Optional[str] = None) -> RunnableSerializable[str, Dict]:
     """Return Chain consisting of retriever, prompt template, LLM and output parser for RAG based on MongoDB Documents.
 
     Uses `MongoDBAtlasProjectionVectorStore`, `MongoDBAtlasProjectionRetriever`, `RunnableParallel`.
@@ -96,57 +294,108 @@ def rag_chain(custom_projection: Optional[Dict] = None, k: int = 4) -> RunnableS
         custom_projection: (Optional) Custom document projection returned from
             the MongoDB collection. Defaults to None.
         k: (Optional) number of documents to return. Defaults to 4.
+        search_type: (Optional) type of search to perform. One of "similarity",
+            "similarity_score_threshold" or "mmr". Defaults to "similarity".
+        search_kwargs: (Optional) additional keyword arguments for the search,
+            e.g. `score_threshold`, `fetch_k` or `lambda_mult`. Defaults to None.
+        embedding_version: (Optional) name of the embedding version to search with.
+            Defaults to None, which uses the current version.
 
     Returns:
-        Chain for RAG.
+        Chain for RAG returning retrieved `context`, `question`, `answer` and `degradation` mode.
     """
-    collection = mongo_connection()
-    vectorstore = MongoDBAtlasProjectionVectorStore(
-        collection, EMBEDDING_MODEL, embedding_key=os.getenv("EMBEDDING_KEY"), index_name=os.getenv("INDEX_NAME"))
+    vectorstore = projection_vectorstore(embedding_version)
 
-    retriever = MongoDBAtlasProjectionRetriever(movie_vectorstore=vectorstore, search_kwargs={
-        "custom_projection": custom_projection, "k": k})
+    retriever = MongoDBAtlasProjectionRetriever(movie_vectorstore=vectorstore, search_type=search_type, search_kwargs={
+        "custom_projection": custom_projection, "k": k, **(search_kwargs or {})})
 
     setup_and_retrieval = RunnableParallel(
         {"context": retriever, "question": RunnablePassthrough()}
     )
 
-    chain = setup_and_retrieval | PROMPT | LLM | OUTPUT_PARSER
+    chain = setup_and_retrieval | RunnableLambda(generate_answer)
 
     return chain
 
 
-def self_querying_vector_search_chain(custom_projection: Optional[Dict] = None, k: int = 4) -> SelfQueryRetriever:
-    """Return Chain consisting of self query retriever for self querying MongoDB Vector Search.
-
-    Uses `MongoDBAtlasProjectionVectorStore` and `SelfQueryRetriever`.
+def self_query_retriever(document_content_description: str, structured_query_cache: LRUCache,
+        custom_projection: Optional[Dict] = None, k: int = 4, search_type: str = "similarity",
+        search_kwargs: Optional[Dict] = None, embedding_version: Optional[str] = None) -> SelfQueryRetriever:
+    """Return self query retriever over the vector store of the MongoDB Collection.
 
     Args:
+        document_content_description: Description of the documents given to the query constructor.
+        structured_query_cache: Cache of the structured queries generated for this description.
         custom_projection: (Optional) Custom document projection returned from
             the MongoDB collection. Defaults to None.
         k: (Optional) number of documents to return. Defaults to 4.
+        search_type: (Optional) type of search to perform. Defaults to "similarity".
+        search_kwargs: (Optional) additional keyword arguments for the search. Defaults to None.
+        embedding_version: (Optional) name of the embedding version to search with.
+            Defaults to None, which uses the current version.
 
     Returns:
-        Chain for MongoDB self query Vector Search.
+        `SelfQueryRetriever` of the collection.
     """
-    collection = mongo_connection()
-    vectorstore = MongoDBAtlasProjectionVectorStore(
-        collection, EMBEDDING_MODEL, embedding_key=os.getenv("EMBEDDING_KEY"), index_name=os.getenv("INDEX_NAME"))
-
-    document_content_description = "Brief summary of a movie"
-    retriever = SelfQueryRetriever.from_llm(
+    return SelfQueryRetriever.from_llm(
         JSON_LLM,
-        vectorstore,
+        projection_vectorstore(embedding_version),
         document_content_description,
         METADATA_FIELD_INFO,
+        search_type=search_type,
         search_kwargs={
-            "custom_projection": custom_projection, "k": k}
+            "custom_projection": custom_projection, "k": k, **(search_kwargs or {})},
+        structured_query_cache=structured_query_cache,
     )
 
-    return retriever
+
+def warm_up_query(query: str) -> None:
+    """Precompute the cached self-query translations and query embeddings of a query.
+
+    Runs the query constructors of both self-querying chains, then embeds the query
+    and the queries rewritten by the query constructors.
+    """
+    queries = {query}
+    for description, cache in ((VECTOR_SEARCH_DOCUMENT_CONTENT_DESCRIPTION, VECTOR_SEARCH_STRUCTURED_QUERIES),
+                               (DOCUMENT_CONTENT_DESCRIPTION, RAG_STRUCTURED_QUERIES)):
+        retriever = self_query_retriever(description, cache)
+        new_query, _ = retriever._prepare_query(query, retriever.construct_query(query))
+        queries.add(new_query)
+    # Both embedding versions are warmed up, the routing can move a query to either of them
+    for version in EMBEDDING_ROUTER.versions.values():
+        for text in queries:
+            version.embedding.embed_query(text)
+
+
+def self_querying_vector_search_chain(custom_projection: Optional[Dict] = None, k: int = 4,
+        search_type: str = "similarity", search_kwargs: Optional[Dict] = None,
+        embedding_version: Optional[str] = None) -> SelfQueryRetriever:
+    """Return Chain consisting of self query retriever for self querying MongoDB Vector Search.
+
+    Uses `MongoDBAtlasProjectionVectorStore` and `SelfQueryRetriever`.
+
+    Args:
+        custom_projection: (Optional) Custom document projection returned from
+            the MongoDB collection. Defaults to None.
+        k: (Optional) number of documents to return. Defaults to 4.
+        search_type: (Optional) type of search to perform. One of "similarity",
+            "similarity_score_threshold" or "mmr". Defaults to "similarity".
+        search_kwargs: (Optional) additional keyword arguments for the search,
+            e.g. `score_threshold`, `fetch_k` or `lambda_mult`. Defaults to None.
+        embedding_version: (Optional) name of the embedding version to search with.
+            Defaults to None, which uses the current version.
+
+    Returns:
+        Chain for MongoDB self query Vector Search.
+    """
+    return self_query_retriever(
+        VECTOR_SEARCH_DOCUMENT_CONTENT_DESCRIPTION, VECTOR_SEARCH_STRUCTURED_QUERIES,
+        custom_projection, k, search_type, search_kwargs, embedding_version)
 
 
-def self_querying_rag_chain(custom_projection: Optional[Dict] = None, k: int = 4) -> RunnableSerializable[str, str]:
+def self_querying_rag_chain(custom_projection: Optional[Dict] = None, k: int = 4,
+        search_type: str = "similarity", search_kwargs: Optional[Dict] = None,
+        embedding_version: Optional[str] = None) -> RunnableSerializable[str, Dict]:
     """Return Chain consisting of self query retriever, prompt template, LLM and output parser for
     self querying RAG based on MongoDB Documents.
 
@@ -156,27 +405,24 @@ def self_querying_rag_chain(custom_projection: Optional[Dict] = None, k: int = 4
         custom_projection: (Optional) Custom document projection returned from
             the MongoDB collection. Defaults to None.
         k: (Optional) number of documents to return. Defaults to 4.
+        search_type: (Optional) type of search to perform. One of "similarity",
+            "similarity_score_threshold" or "mmr". Defaults to "similarity".
+        search_kwargs: (Optional) additional keyword arguments for the search,
+            e.g. `score_threshold`, `fetch_k` or `lambda_mult`. Defaults to None.
+        embedding_version: (Optional) name of the embedding version to search with.
+            Defaults to None, which uses the current version.
 
     Returns:
-        Chain for self query RAG.
+        Chain for self query RAG returning retrieved `context`, `question`, `answer` and `degradation` mode.
     """
-    collection = mongo_connection()
-    vectorstore = MongoDBAtlasProjectionVectorStore(
-        collection, EMBEDDING_MODEL, embedding_key=os.getenv("EMBEDDING_KEY"), index_name=os.getenv("INDEX_NAME"))
-
-    retriever = SelfQueryRetriever.from_llm(
-        JSON_LLM,
-        vectorstore,
-        DOCUMENT_CONTENT_DESCRIPTION,
-        METADATA_FIELD_INFO,
-        search_kwargs={
-            "custom_projection": custom_projection, "k": k}
-    )
+    retriever = self_query_retriever(
+        DOCUMENT_CONTENT_DESCRIPTION, RAG_STRUCTURED_QUERIES, custom_projection, k, search_type, search_kwargs,
+        embedding_version)
 
     setup_and_retrieval = RunnableParallel(
         {"context": retriever, "question": RunnablePassthrough()}
     )
 
-    chain = setup_and_retrieval | PROMPT | LLM | OUTPUT_PARSER
+    chain = setup_and_retrieval | RunnableLambda(generate_answer)
 
     return chain
@@ -0,0 +1,205 @@
+""" On-demand profiling of API requests
+"""
+import contextvars
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from rag.projection_self_query_retriever import QUERY_CONSTRUCTOR_RUN_NAME
+
+# Functions whose cumulative time from the profile is reported as a stage
+PROFILED_STAGES = {
+    "embed_query": "embedding",
+    "aggregate": "aggregation",
+}
+
+_ACTIVE_CALLBACKS: contextvars.ContextVar[List[BaseCallbackHandler]] = contextvars.ContextVar(
+    "active_callbacks", default=[])
+
+
+def active_callbacks() -> List[BaseCallbackHandler]:
+    """Return callbacks that should be passed to chains run by the current request."""
+    return _ACTIVE_CALLBACKS.get()
+
+
+class StageTimer(BaseCallbackHandler):
+    """Callback handler recording durations of the retriever, query constructor and LLM runs."""
+
+    def __init__(self):
+        self.timings: List[Dict[str, Any]] = []
+        self._starts: Dict[UUID, tuple] = {}
+
+    def _start(self, run_id: UUID, stage: str) -> None:
+        self._starts[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id: UUID) -> None:
+        if run_id not in self._starts:
+            return
+        stage, start = self._starts.pop(run_id)
+        self.timings.append({"stage": stage, "seconds": time.perf_counter() - start})
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs) -> None:
+        if kwargs.get("name") == QUERY_CONSTRUCTOR_RUN_NAME:
+            self._start(run_id, "query_constructor")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs) -> None:
+        self._start(run_id, "retriever")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+
+class WorkerProfiler(BaseCallbackHandler):
+    """Callback handler profiling retriever runs on threads other than the request thread.
+
+    Chains like `RunnableParallel` run the retriever on worker threads, which the profiler
+    of the request thread does not see. Their profiles are merged into the request profile.
+    """
+
+    def __init__(self):
+        self.profiles: List[cProfile.Profile] = []
+        self._thread_id = threading.get_ident()
+        self._running: Dict[UUID, cProfile.Profile] = {}
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs) -> None:
+        if threading.get_ident() == self._thread_id:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active profiler, the retriever is not profiled separately
+            return
+        self._running[run_id] = profiler
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs) -> None:
+        profiler = self._running.pop(run_id, None)
+        if profiler is not None:
+            profiler.disable()
+            self.profiles.append(profiler)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs) -> None:
+        self.on_retriever_end(None, run_id=run_id)
+
+
+class RequestProfiler:
+    """Profiler of requests selected explicitly or by sampling a fraction of traffic.
+
+    Profiles are kept in memory together with the endpoint, parameters and stage timings
+    of the request. Retrievers run on worker threads are profiled by `WorkerProfiler`, other
+    work on worker threads, e.g. hedged calls, is missing from the profile. Only one request
+    is profiled at a time, concurrent requests selected for profiling run unprofiled.
+
+    Args:
+        sample_rate: (Optional) fraction of requests profiled without being requested.
+            Defaults to 0.
+        history: (Optional) number of most recent profiles kept. Defaults to 50.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, history: int = 50):
+        self.sample_rate = sample_rate
+        self._profiles = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def should_profile(self, requested: bool = False) -> bool:
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def profile(self, func: Callable, endpoint: str, params: Dict[str, Any], *args: Any, **kwargs: Any) -> Any:
+        """Run `func` under cProfile and store the profile.
+
+        Args:
+            func: Function handling the request.
+            endpoint: Path of the request.
+            params: Parameters of the request.
+            *args: Positional arguments passed to `func`.
+            **kwargs: Keyword arguments passed to `func`.
+
+        Returns:
+            Result of `func`.
+        """
+        if not self._lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            stage_timer = StageTimer()
+            worker_profiler = WorkerProfiler()
+            token = _ACTIVE_CALLBACKS.set([stage_timer, worker_profiler])
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                result = profiler.runcall(func, *args, **kwargs)
+            finally:
+                total = time.perf_counter() - start
+                _ACTIVE_CALLBACKS.reset(token)
+                stats = pstats.Stats(profiler)
+                for worker in worker_profiler.profiles:
+                    stats.add(worker)
+                self._store(stats.stats, endpoint, params, total, stage_timer.timings)
+            return result
+        finally:
+            self._lock.release()
+
+    def _store(self, stats: Dict, endpoint: str, params: Dict[str, Any], total: float,
+               timings: List[Dict[str, Any]]) -> None:
+        stages = list(timings)
+        for stage_function, stage in PROFILED_STAGES.items():
+            seconds = [ct for (_, _, name), (_, _, _, ct, _) in stats.items() if name == stage_function]
+            if seconds:
+                stages.append({"stage": stage, "seconds": max(seconds)})
+        self._profiles.append({
+            "id": secrets.token_hex(8),
+            "timestamp": time.time(),
+            "endpoint": endpoint,
+            "params": params,
+            "total_seconds": total,
+            "stages": stages,
+            "stats": marshal.dumps(stats),
+        })
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Return metadata of stored profiles, most recent first."""
+        return [{key: value for key, value in profile.items() if key != "stats"}
+                for profile in reversed(self._profiles)]
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        """Return stored profile by its id, None when it does not exist."""
+        for profile in self._profiles:
+            if profile["id"] == profile_id:
+                return profile
+        return None
+
+
+def stats_to_text(stats: bytes, limit: int = 50) -> str:
+    """Return human-readable summary of marshalled profile stats sorted by cumulative time."""
+    stream = io.StringIO()
+    loaded = pstats.Stats(stream=stream)
+    loaded.stats = marshal.loads(stats)
+    loaded.get_top_level_stats()
+    loaded.sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
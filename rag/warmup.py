@@ -0,0 +1,83 @@
+""" Background warm-up of query caches from a historical query log
+"""
+import json
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+
+def top_queries(path: str, n: int) -> List[str]:
+    """Return the `n` most frequent queries of a JSONL query log.
+
+    Every line of the log is a JSON object with a `query` (or `title`) field.
+    """
+    counts = Counter()
+    with open(path, encoding="utf-8") as log:
+        for line in log:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            query = entry.get("query") or entry.get("title")
+            if query:
+                counts[query] += 1
+    return [query for query, _ in counts.most_common(n)]
+
+
+class WarmUp:
+    """Runs a warm-up function for every query on a background thread.
+
+    Args:
+        queries: Queries to warm up, most important first.
+        warm_up: Function precomputing the cached results of a single query.
+        rate: (Optional) maximal number of queries warmed up per second. Defaults to None,
+            which does not limit the rate.
+        report_every: (Optional) number of queries after which the progress is printed.
+            Defaults to 10.
+    """
+
+    def __init__(self, queries: List[str], warm_up: Callable[[str], None], rate: Optional[float] = None,
+                 report_every: int = 10):
+        self.queries = queries
+        self.warm_up = warm_up
+        self.rate = rate
+        self.report_every = report_every
+        self.done = 0
+        self.failed = 0
+        self.finished = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+
+    def start(self) -> "WarmUp":
+        self._thread.start()
+        return self
+
+    @property
+    def fraction(self) -> float:
+        """Fraction of the queries warmed up, failed queries included."""
+        return self.done / len(self.queries) if self.queries else 1.0
+
+    def progress(self) -> Dict:
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "total": len(self.queries),
+            "fraction": round(self.fraction, 4),
+            "finished": self.finished.is_set(),
+        }
+
+    def _run(self) -> None:
+        start = time.monotonic()
+        print(f"Warm-up of {len(self.queries)} queries started")
+        for i, query in enumerate(self.queries):
+            if self.rate:
+                time.sleep(max(0.0, start + i / self.rate - time.monotonic()))
+            try:
+                self.warm_up(query)
+            except Exception as e:
+                print("An error occurred:", e)
+                self.failed += 1
+            self.done += 1
+            if self.done % self.report_every == 0 and self.done < len(self.queries):
+                print(f"Warm-up: {self.done}/{len(self.queries)} queries")
+        self.finished.set()
+        print(f"Warm-up of {self.done} queries finished in {time.monotonic() - start:.1f}s, {self.failed} failed")